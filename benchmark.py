@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# Benchmarks of the conversion and of the sync, on synthetic data (rmgen.py).
+#
+# For every scale (number of documents) a backup directory is generated and
+# the following are timed:
+#   rm2svg:        SVG rendering of one annotated page per document
+#   convertFiles:  export of the whole backup to the library, then a second
+#                  export with nothing changed
+#   uploadPlan:    planning the upload of the exported library, with one new
+#                  library file per 10 documents
+#   metadataPaths: building the metadata index and resolving the library
+#                  path of every entry
+# The results are written as JSON, to compare them across changes.
+#
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import contextlib
+from argparse import ArgumentParser
+
+import rM2svg
+import rmgen
+import sync
+from rmindex import MetadataIndex
+from profiles import Profile
+
+
+def timed(function, *args, **kwargs):
+    # returns the seconds function took, its output is discarded
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        return time.perf_counter() - start
+
+
+def useDirectories(backup, library):
+    # Points the sync at the generated backup and library, with fresh state
+    sync.useProfile(Profile("benchmark", library, backup, sync.remarkableIP, sync.remarkableUsername))
+    sync.templateDigests.clear()
+    sync.templatePages.clear()
+
+
+def benchmarkSVG(backup, output):
+    pages = []
+    xochitl = os.path.join(backup, 'xochitl')
+    for UUID in sorted(os.listdir(xochitl)):
+        directory = os.path.join(xochitl, UUID)
+        if os.path.isdir(directory) and os.listdir(directory):
+            pages.append(os.path.join(directory, sorted(os.listdir(directory))[0]))
+    rM2svg.page_cache.clear()
+
+    def render():
+        for page in pages:
+            rM2svg.rm2svg(page, os.path.join(output, "page"))
+    seconds = timed(render)
+    return {"pages": len(pages), "seconds": seconds, "pagesPerSecond": len(pages) / seconds if seconds else None}
+
+
+def benchmarkConvert(jobs):
+    cold = timed(sync.convertFiles, jobs)
+    sync.resetIndex()
+    warm = timed(sync.convertFiles, jobs)
+    return {"jobs": jobs, "seconds": cold, "unchangedSeconds": warm}
+
+
+def benchmarkUpload(backup, library, documents):
+    basePDF = os.path.join(backup, 'base.pdf')
+    new = max(1, documents // 10)
+    for n in range(new):
+        directory = os.path.join(library, "New", "Batch %d" % (n // 50))
+        os.makedirs(directory, exist_ok=True)
+        shutil.copyfile(basePDF, os.path.join(directory, "Upload %d.pdf" % n))
+        # distinct contents, so that they are not taken for moved documents
+        with open(os.path.join(directory, "Upload %d.pdf" % n), 'ab') as f:
+            f.write(b"%% %d\n" % n)
+    sync.resetIndex()
+    plans = []
+    seconds = timed(lambda: plans.append(sync.prepareUpload(True)))
+    return {"newFiles": new, "plannedEntries": len(plans[0]), "seconds": seconds}
+
+
+def benchmarkPaths(backup):
+    directory = os.path.join(backup, 'xochitl')
+    start = time.perf_counter()
+    index = MetadataIndex(directory)
+    scanned = time.perf_counter()
+    for UUID in index.entries:
+        index.path(index[UUID].get('parent', ''))
+    resolved = time.perf_counter()
+    return {"entries": len(index.entries), "scanSeconds": scanned - start, "resolveSeconds": resolved - scanned}
+
+
+def benchmark(directory, documents, jobs=1, svg=True, convert=True, upload=True):
+    backup = os.path.join(directory, "backup")
+    library = os.path.join(directory, "library")
+    output = os.path.join(directory, "svg")
+    os.makedirs(library)
+    os.makedirs(output)
+    start = time.perf_counter()
+    rmgen.makeTree(backup, documents)
+    result = {"documents": documents, "generateSeconds": time.perf_counter() - start}
+
+    useDirectories(backup, library)
+    result["metadataPaths"] = benchmarkPaths(backup)
+    if svg:
+        result["rm2svg"] = benchmarkSVG(backup, output)
+    if convert:
+        result["convertFiles"] = benchmarkConvert(jobs)
+    if upload:
+        result["uploadPlan"] = benchmarkUpload(backup, library, documents)
+    sync.loadState().close()
+    return result
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the conversion and the sync on synthetic data")
+    parser.add_argument("-o", "--output", help="JSON file of the results (default: standard output)")
+    parser.add_argument("-n", "--scales", help="comma separated numbers of documents", default="10,1000,10000")
+    parser.add_argument("-j", "--jobs", help="number of documents converted in parallel", type=int, default=1)
+    parser.add_argument("--skip", help="comma separated benchmarks to skip: rm2svg, convertFiles, uploadPlan",
+                        default="")
+    parser.add_argument("--keep", help="keep the generated data in this directory")
+    args = parser.parse_args()
+    skip = set(args.skip.split(","))
+
+    results = {
+        "version": sync.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scales": [],
+    }
+    root = args.keep or tempfile.mkdtemp(prefix="rmbench")
+    try:
+        for documents in [int(n) for n in args.scales.split(",")]:
+            print("benchmarking " + str(documents) + " documents", file=sys.stderr)
+            directory = os.path.join(root, str(documents))
+            shutil.rmtree(directory, ignore_errors=True)
+            results["scales"].append(benchmark(directory, documents, args.jobs, "rm2svg" not in skip,
+                                               "convertFiles" not in skip, "uploadPlan" not in skip))
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Timing of the stages of a sync run.
+#
+# Every stage is timed with
+#   with metrics.stage("name"):
+#       ...
+# and the seconds and the number of runs of each stage are summed. Stages
+# can be nested, a stage then includes the time of the stages it contains.
+# The summary is written as JSON with --metrics.
+#
+import time
+import json
+import contextlib
+
+
+class Metrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}     # name -> [seconds, runs]
+        self.counters = {}   # name -> count
+        self.documents = []  # {"uuid", "name", "seconds"} of every exported document
+
+    def reset(self):
+        self.__init__()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, runs=1):
+        entry = self.stages.setdefault(name, [0., 0])
+        entry[0] += seconds
+        entry[1] += runs
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, stages):
+        # Adds the stages timed in a worker process
+        for name, (seconds, runs) in stages.items():
+            self.add(name, seconds, runs)
+
+    def summary(self):
+        return {
+            "seconds": time.perf_counter() - self.start,
+            "stages": {name: {"seconds": seconds, "runs": runs}
+                       for name, (seconds, runs) in sorted(self.stages.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "documents": sorted(self.documents, key=lambda document: -document["seconds"]),
+        }
+
+    def dump(self, path):
+        with open(path, "w") as outfile:
+            json.dump(self.summary(), outfile, indent=1)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# Profiles of the sync: the tablet, the library and the backup folder of
+# every device synced by one run.
+#
+# The --devices file of sync.py is a JSON object with a list of profiles,
+# each with the settings of the top of sync.py it changes, and optionally a
+# folder for the caches shared by the profiles (rendered pages and
+# templates):
+#   {
+#    "cache": "/home/me/.cache/rmsync",
+#    "profiles": [
+#     {"name": "alice", "syncDirectory": "/home/me/Alice", "remarkablePCDirectory": "/home/me/.alice",
+#      "remarkableIP": "192.168.1.20"},
+#     {"name": "bob", "syncDirectory": "/home/me/Bob", "remarkablePCDirectory": "/home/me/.bob",
+#      "remarkableIP": "192.168.1.21"}
+#    ]
+#   }
+#
+import os
+import json
+
+
+class Profile:
+    # The settings of one device, and the folder of the caches it shares
+    # with the other profiles ("" for its backup folder). Its sync state and
+    # metadata index are opened on first use by the process using them, a
+    # profile sent to a worker process only carries its settings and its
+    # cache folder.
+    settings = ("name", "syncDirectory", "remarkablePCDirectory", "remarkableIP", "remarkableUsername",
+                "remarkableMirror")
+
+    def __init__(self, name, syncDirectory, remarkablePCDirectory, remarkableIP, remarkableUsername,
+                 remarkableMirror="", cacheDirectory=""):
+        self.name = name
+        self.syncDirectory = syncDirectory
+        self.remarkablePCDirectory = remarkablePCDirectory
+        self.remarkableIP = remarkableIP
+        self.remarkableUsername = remarkableUsername
+        self.remarkableMirror = remarkableMirror
+        self.cacheDirectory = cacheDirectory
+        self.state = None  # SyncState
+        self.index = None  # MetadataIndex
+
+    def cacheFolder(self):
+        return self.cacheDirectory or self.remarkablePCDirectory
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.settings + ("cacheDirectory",)}
+
+    def __setstate__(self, values):
+        self.__init__(**values)
+
+
+def loadProfiles(path, defaults):
+    # Reads a profile file, the settings missing from a profile are taken
+    # from defaults. The profiles share the cache folder of the file, by
+    # default the backup folder of the first profile.
+    # returns the profiles
+    with open(path) as f:
+        config = json.load(f)
+    if not isinstance(config, dict) or not all(isinstance(entry, dict) for entry in config.get("profiles", [])):
+        raise ValueError("expected an object with a list of profile objects")
+    profiles = []
+    for n, entry in enumerate(config.get("profiles", [])):
+        unknown = set(entry) - set(Profile.settings)
+        if unknown:
+            raise ValueError("unknown profile settings: " + ", ".join(sorted(unknown)))
+        values = {key: defaults[key] for key in Profile.settings}
+        values["name"] = "profile " + str(n + 1)
+        values.update(entry)
+        profiles.append(Profile(**values))
+    if not profiles:
+        raise ValueError(path + " has no profiles")
+    # the state of a sync is kept in its backup folder
+    backups = [os.path.abspath(profile.remarkablePCDirectory) for profile in profiles]
+    if len(set(backups)) != len(backups):
+        raise ValueError("every profile needs its own backup folder")
+    cache = config.get("cache") or profiles[0].remarkablePCDirectory
+    for profile in profiles:
+        profile.cacheDirectory = cache
+    return profiles
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+#
+# Script for converting reMarkable tablet ".rm" files to PDF.
+#
+# The strokes parsed by rM2svg are written straight into PDF vector content
+# streams, so no intermediate SVG file or external converter is needed.
+# Every input page becomes one page of the output PDF. The drawing follows
+# the same pen width/opacity rules as rM2svg.
+#
+import io
+import os
+import zlib
+import hashlib
+import argparse
+import contextlib
+
+import numpy as np
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject
+from PyPDF2.pdf import PageObject
+
+from rM2svg import (default_x_width, default_y_width, load_page, load_page_or_blank,
+                    pen_style, scale_points, segment_styles, stroke_colours)
+
+
+__prog_name__ = "rm2pdf"
+__version__ = "0.0.2"
+
+
+# SVG colour names used by rM2svg
+colour_rgb = {
+    "black": (0., 0., 0.),
+    "grey": (128 / 255, 128 / 255, 128 / 255),
+    "white": (1., 1., 1.),
+    "blue": (0., 0., 1.),
+    "red": (1., 0., 0.),
+    "yellow": (1., 1., 0.),
+}
+
+# Part of the key of the cached overlays, bump it when the parsing or the
+# rendering of the pages changes so that the cached pages are rendered again
+overlay_cache_version = 2
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__prog_name__)
+    parser.add_argument('--height',
+                        help='Desired height of the pages',
+                        type=float,
+                        default=default_y_width)
+    parser.add_argument('--width',
+                        help='Desired width of the pages',
+                        type=float,
+                        default=default_x_width)
+    parser.add_argument("-i",
+                        "--input",
+                        help=".rm input files, one per page",
+                        required=True,
+                        nargs='+',
+                        metavar="FILENAME",
+                        )
+    parser.add_argument("-o",
+                        "--output",
+                        help="output PDF file",
+                        required=True,
+                        metavar="NAME",
+                        )
+    parser.add_argument("-c",
+                        "--coloured_annotations",
+                        help="Colour annotations for document markup.",
+                        action='store_true',
+                        )
+    parser.add_argument('--version',
+                        action='version',
+                        version='%(prog)s {version}'.format(version=__version__))
+    args = parser.parse_args()
+
+    for input_file in args.input:
+        if not os.path.exists(input_file):
+            parser.error('The file "{}" does not exist!'.format(input_file))
+
+    rm2pdf(args.input, args.output, args.coloured_annotations,
+           args.width, args.height)
+
+
+class PageStream:
+    # A rendered page: its size, the compressed content stream and the
+    # opacities the stream refers to (as /GA<opacity*1000> graphics states)
+    __slots__ = ('width', 'height', 'data', 'alphas')
+
+    def __init__(self, width, height, data, alphas):
+        self.width = width
+        self.height = height
+        self.data = data
+        self.alphas = alphas
+
+
+class OverlayCache:
+    # Rendered pages kept on disk, keyed by the hash of the .rm file and the
+    # rendering parameters. A page is only rendered again when its strokes
+    # changed.
+    # stage(name) returns a context manager timing the parsing and the
+    # rendering of the pages, a Metrics.stage can be plugged in.
+    def __init__(self, directory, stage=None):
+        self.directory = directory
+        self.stage = stage if stage is not None else lambda name: contextlib.nullcontext()
+
+    def path(self, data, width, height, coloured_annotations):
+        digest = hashlib.sha1(data)
+        digest.update('{:.2f}x{:.2f}:{:d}:v{:d}'.format(width, height, coloured_annotations,
+                                                        overlay_cache_version).encode('ascii'))
+        return os.path.join(self.directory, digest.hexdigest())
+
+    def get(self, input_file, width=default_x_width, height=default_y_width,
+            coloured_annotations=False):
+        with open(input_file, 'rb') as f:
+            data = f.read()
+        path = self.path(data, width, height, coloured_annotations)
+        try:
+            with open(path, 'rb') as f:
+                alphas, stream = f.read().split(b'\n', 1)
+            # the modification time tells prune the page was used
+            os.utime(path)
+            return PageStream(width, height, stream, tuple(int(alpha) for alpha in alphas.split()))
+        except FileNotFoundError:
+            pass
+
+        with self.stage('parse'):
+            strokes = load_page(input_file, data)
+        with self.stage('render'):
+            page = render_page(strokes, width, height, coloured_annotations)
+        os.makedirs(self.directory, exist_ok=True)
+        # Concurrent workers may render the same page, the rename keeps
+        # the entry whole
+        with open(path + '.{}.tmp'.format(os.getpid()), 'wb') as f:
+            f.write(' '.join(str(alpha) for alpha in page.alphas).encode('ascii'))
+            f.write(b'\n')
+            f.write(page.data)
+        os.replace(path + '.{}.tmp'.format(os.getpid()), path)
+        return page
+
+    def prune(self, max_bytes):
+        # Removes the pages used least recently until the cache holds at
+        # most max_bytes
+        # returns the number of pages removed
+        try:
+            # the pages being written are left alone
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.is_file() and not entry.name.endswith('.tmp')]
+        except (FileNotFoundError, NotADirectoryError):
+            # no cache yet
+            return 0
+        pages = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries)
+        total = sum(size for mtime, size, path in pages)
+        removed = 0
+        for mtime, size, path in pages:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+
+def blank_page(width=default_x_width, height=default_y_width):
+    return PageStream(width, height, zlib.compress(b''), ())
+
+
+def format_path(xpos, ypos):
+    # Format a polyline as PDF path construction operators
+    xy = np.empty(2 * len(xpos))
+    xy[0::2] = xpos
+    xy[1::2] = ypos
+    return ('{:.2f} {:.2f} m\n' + '{:.2f} {:.2f} l\n' * (len(xpos) - 1)).format(*xy.tolist())
+
+
+def render_page(page, width=default_x_width, height=default_y_width,
+                coloured_annotations=False):
+    # Render a parsed page to a PDF page of the given size (in points)
+    colours = stroke_colours(coloured_annotations)
+    alphas = set()
+    state = {'colour': None, 'width': None, 'alpha': 1000}
+
+    # Flip the y axis so that the SVG coordinates of rM2svg can be used as is
+    content = ['1 0 0 -1 0 {:.2f} cm\n0 J 0 j 4 M\n'.format(height)]
+
+    def polyline(colour, stroke_width, opacity, xpos, ypos):
+        if len(xpos) < 2 or stroke_width == 0 or opacity <= 0:
+            return
+        if stroke_width < 0:
+            stroke_width = 1 # invalid in SVG, falls back to the initial value
+        alpha = int(round(min(opacity, 1) * 1000))
+        if alpha != state['alpha']:
+            alphas.add(alpha)
+            content.append('/GA{} gs\n'.format(alpha))
+            state['alpha'] = alpha
+        if colour != state['colour']:
+            content.append('{:.3f} {:.3f} {:.3f} RG\n'.format(*colour_rgb[colour]))
+            state['colour'] = colour
+        if stroke_width != state['width']:
+            content.append('{:.3f} w\n'.format(stroke_width))
+            state['width'] = stroke_width
+        content.append(format_path(xpos, ypos))
+        content.append('S\n')
+
+    for stroke in page.strokes():
+        segments = stroke.segments
+        colour, stroke_width, opacity = pen_style(stroke.pen, stroke.colour, stroke.width, coloured_annotations)
+        if opacity == 0:
+            continue # Erasers are not drawn
+        colour = colours[colour]
+        xpos, ypos = scale_points(segments, width, height)
+        widths, opacities = segment_styles(stroke.pen, stroke_width, segments)
+        if widths is None:
+            polyline(colour, stroke_width, opacity, xpos, ypos)
+            continue
+        # Dynamic width, one sub-polyline every 8 segments joined to the
+        # first point of the previous one
+        for i, segment_width in enumerate(widths.tolist()):
+            start = 8 * i
+            points = slice(start, start + 8)
+            if i > 0 and xpos[start - 8] != -1.:
+                points = np.r_[start - 8, start:min(start + 8, len(xpos))]
+            segment_opacity = 1 if opacities is None else opacities[i]
+            polyline(colour, segment_width, segment_opacity, xpos[points], ypos[points])
+
+    data = zlib.compress(''.join(content).encode('ascii'))
+    return PageStream(width, height, data, tuple(sorted(alphas)))
+
+
+def write_pdf(pages, output_name):
+    # Write the rendered pages as a single PDF file, output_name can also be
+    # a binary file object
+    if isinstance(output_name, (str, bytes, os.PathLike)):
+        with open(output_name, 'wb') as output:
+            write_pdf(pages, output)
+        return
+
+    output = output_name
+    offsets = []
+    npages = len(pages)
+    # Object numbers: 1 catalog, 2 page tree, then a page and its content
+    # stream for every page
+    kids = ' '.join('{} 0 R'.format(3 + 2 * i) for i in range(npages))
+
+    def write_object(body, stream=None):
+        offsets.append(output.tell())
+        output.write('{} 0 obj\n'.format(len(offsets)).encode('ascii'))
+        output.write(body.encode('ascii'))
+        if stream is not None:
+            output.write(b'\nstream\n')
+            output.write(stream)
+            output.write(b'\nendstream')
+        output.write(b'\nendobj\n')
+
+    output.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    write_object('<< /Type /Catalog /Pages 2 0 R >>')
+    write_object('<< /Type /Pages /Kids [{}] /Count {} >>'.format(kids, npages))
+    for i, page in enumerate(pages):
+        gstates = ' '.join('/GA{0} << /Type /ExtGState /CA {1:.3f} /ca {1:.3f} >>'.format(alpha, alpha / 1000)
+                           for alpha in page.alphas)
+        write_object('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {:.2f} {:.2f}] '
+                     '/Resources << /ExtGState << {} >> >> /Contents {} 0 R >>'.format(
+                         page.width, page.height, gstates, 4 + 2 * i))
+        write_object('<< /Length {} /Filter /FlateDecode >>'.format(len(page.data)), page.data)
+
+    xref = output.tell()
+    output.write('xref\n0 {}\n0000000000 65535 f \n'.format(len(offsets) + 1).encode('ascii'))
+    output.write(''.join('{:010d} 00000 n \n'.format(offset) for offset in offsets).encode('ascii'))
+    output.write('trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(
+        len(offsets) + 1, xref).encode('ascii'))
+
+
+def page_origin(page):
+    box = page.mediaBox
+    return float(box.getLowerLeft_x()), float(box.getLowerLeft_y())
+
+
+def copy_page(page):
+    # New page object sharing the content and resources of page, so that a
+    # page can be used several times without copying its content
+    copy = PageObject(page.pdf)
+    copy.update(page)
+    return copy
+
+
+def stamp_pdf(base_pages, overlays, output_name):
+    # Write base_pages (PyPDF2 pages) to output_name, with the PageStream
+    # overlays[i] drawn on top of page i. Pages without an overlay are
+    # copied untouched.
+    #
+    # The overlay is appended to the content array of the page, the content
+    # of the base page is referenced as it is instead of being decoded and
+    # merged into a new stream.
+    #
+    # The base content is wrapped in q/Q so that it can not move the overlay.
+    # These streams are written in the overlay file as the content of extra
+    # pages, the writer copies them with the pages that refer to them.
+    indices = sorted(overlays)
+    origins = sorted({page_origin(base_pages[i]) for i in indices})
+    glue = [b'q\n'] + ['\nQ\n1 0 0 1 {:.2f} {:.2f} cm\n'.format(*origin).encode('ascii') for origin in origins]
+    overlay_file = io.BytesIO()
+    write_pdf([overlays[i] for i in indices] + [PageStream(0, 0, zlib.compress(data), ()) for data in glue],
+              overlay_file)
+    overlay_pdf = PdfFileReader(overlay_file)
+    stamps = dict(zip(indices, range(len(indices))))
+    save = overlay_pdf.getPage(len(indices)).raw_get('/Contents')
+    restore = {origin: overlay_pdf.getPage(len(indices) + 1 + n).raw_get('/Contents')
+               for n, origin in enumerate(origins)}
+
+    writer = PdfFileWriter()
+    for i, page in enumerate(base_pages):
+        if i in stamps:
+            stamp = overlay_pdf.getPage(stamps[i])
+            contents = page.raw_get('/Contents') if '/Contents' in page else ArrayObject()
+            if not isinstance(contents, ArrayObject):
+                contents = [contents]
+            page[NameObject('/Contents')] = ArrayObject(
+                [save] + list(contents) + [restore[page_origin(page)], stamp.raw_get('/Contents')])
+
+            # the resources of a template page are shared by all the pages
+            # copied from it, the page gets its own
+            resources = DictionaryObject(page['/Resources']) if '/Resources' in page else DictionaryObject()
+            gstates = DictionaryObject(resources['/ExtGState']) if '/ExtGState' in resources else DictionaryObject()
+            gstates.update(stamp['/Resources']['/ExtGState'])
+            resources[NameObject('/ExtGState')] = gstates
+            page[NameObject('/Resources')] = resources
+        writer.addPage(page)
+
+    # Write next to the destination and rename, a failed export never
+    # leaves a truncated file behind
+    with open(output_name + '.tmp', 'wb') as output:
+        writer.write(output)
+    os.replace(output_name + '.tmp', output_name)
+
+
+def rm2pdf(input_files, output_name, coloured_annotations=False,
+           x_width=default_x_width, y_width=default_y_width):
+    pages = [render_page(load_page_or_blank(input_file), x_width, y_width, coloured_annotations)
+             for input_file in input_files]
+    write_pdf(pages, output_name)
+
+
+if __name__ == "__main__":
+    main()
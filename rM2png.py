@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+#
+# Script for converting reMarkable tablet ".rm" files to PNG images.
+#
+# The strokes parsed by rM2svg are rasterized straight into a NumPy image,
+# with the same pen width/opacity rules as rM2svg and rM2pdf, and written as
+# PNG with zlib, so no SVG renderer is needed. A stroke covers the pixels
+# within half its width of its polyline (round caps and joins), its opacity
+# is applied once to the whole stroke as in SVG. Small --width values give
+# thumbnails.
+#
+import os
+import zlib
+import struct
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rM2svg import (FormatError, abort, convert_or_skip, default_x_width, default_y_width, input_pages,
+                    load_page, pen_style, scale_points, segment_styles, stroke_colours)
+from rM2pdf import colour_rgb
+
+
+__prog_name__ = "rm2png"
+__version__ = "0.0.2"
+
+# Pixels computed at once, bounds the memory used by large pages
+chunk_pixels = 1 << 21
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__prog_name__)
+    parser.add_argument('--width',
+                        help='Width of the images in pixels, the height follows the page',
+                        type=int,
+                        default=default_x_width)
+    parser.add_argument("-i",
+                        "--input",
+                        help=".rm input files, document directories or quoted globs of .rm files",
+                        required=True,
+                        nargs='+',
+                        metavar="FILENAME",
+                        )
+    parser.add_argument("-o",
+                        "--output",
+                        help="output file for a single page, prefix of the output files otherwise",
+                        required=True,
+                        metavar="NAME",
+                        )
+    parser.add_argument("-c",
+                        "--coloured_annotations",
+                        help="Colour annotations for document markup.",
+                        action='store_true',
+                        )
+    parser.add_argument("-j",
+                        "--jobs",
+                        help="number of pages converted in parallel",
+                        type=int,
+                        default=1)
+    parser.add_argument('--version',
+                        action='version',
+                        version='%(prog)s {version}'.format(version=__version__))
+    args = parser.parse_args()
+
+    if len(args.input) == 1 and os.path.isfile(args.input[0]):
+        try:
+            rm2png(args.input[0], args.output, args.coloured_annotations, args.width)
+        except FormatError as error:
+            abort(str(error))
+        return
+
+    input_files = []
+    for name in args.input:
+        pages = [name] if os.path.isfile(name) else input_pages(name)
+        if not pages:
+            parser.error('No .rm files found for "{}"!'.format(name))
+        input_files.extend(pages)
+    batch2png(input_files, args.output, args.coloured_annotations, args.width, args.jobs)
+
+
+def expand_spans(starts, lengths):
+    # Concatenation of the ranges starts[i]..starts[i] + lengths[i]
+    # returns the values and the index of the range of each value
+    span = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(len(span)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[span] + offsets, span
+
+
+class Polylines:
+    # The polylines drawn on a page, in drawing order: their segments
+    # (a -> b, index of their polyline) and, for every polyline, its half
+    # width, opacity and colour
+    def __init__(self):
+        self.segments = []   # (ax, ay, bx, by, polyline) arrays
+        self.styles = []     # (radius, opacity, rgb) arrays
+        self.count = 0
+
+    def add(self, xpos, ypos, start, end, polyline, widths, opacities, rgb):
+        # Segments start[i] -> end[i] of the polylines polyline[i], numbered
+        # from 0, with the given widths and opacities
+        widths = np.asarray(widths, dtype=np.float64)
+        opacities = np.broadcast_to(np.asarray(opacities, dtype=np.float64), widths.shape)
+        # erasers are not drawn, an invalid (negative) SVG width falls back
+        # to the initial value
+        drawn = (widths != 0) & (opacities > 0)
+        widths = np.where(widths < 0, 1., widths)
+        keep = drawn[polyline]
+        number = np.cumsum(drawn) - 1 + self.count
+        self.segments.append((xpos[start[keep]], ypos[start[keep]], xpos[end[keep]], ypos[end[keep]],
+                              number[polyline[keep]]))
+        self.styles.append((widths[drawn] / 2, opacities[drawn],
+                            np.broadcast_to(np.asarray(rgb, dtype=np.float32), (int(drawn.sum()), 3))))
+        self.count += int(drawn.sum())
+
+    def arrays(self):
+        if not self.segments:
+            return None
+        ax, ay, bx, by, polyline = (np.concatenate(column) for column in zip(*self.segments))
+        radius, opacity, rgb = (np.concatenate(column) for column in zip(*self.styles))
+        order = np.argsort(polyline, kind='stable')
+        return ax[order], ay[order], bx[order], by[order], polyline[order], radius, opacity, rgb
+
+
+def page_polylines(page, scale=1., coloured_annotations=False):
+    # The polylines of the strokes of a page scaled by scale, the strokes
+    # with a dynamic width are split every 8 segments as in rM2svg
+    colours = stroke_colours(coloured_annotations)
+    polylines = Polylines()
+    for stroke in page.strokes():
+        segments = stroke.segments
+        colour, stroke_width, opacity = pen_style(stroke.pen, stroke.colour, stroke.width, coloured_annotations)
+        if opacity == 0 or len(segments) < 2:
+            continue # Erasers are not drawn
+        rgb = colour_rgb[colours[colour]]
+        xpos, ypos = scale_points(segments, default_x_width, default_y_width)
+        xpos *= scale
+        ypos *= scale
+        points = np.arange(len(xpos) - 1)
+        widths, opacities = segment_styles(stroke.pen, stroke_width, segments)
+        if widths is None:
+            polylines.add(xpos, ypos, points, points + 1, np.zeros(len(points), dtype=np.int64),
+                          [stroke_width * scale], opacity, rgb)
+            continue
+        # Dynamic width, one sub-polyline every 8 segments joined to the
+        # first point of the previous one
+        inner = points[(points + 1) // 8 == points // 8]
+        joins = np.arange(1, len(widths))
+        joins = joins[xpos[8 * joins - 8] != -1.]
+        polylines.add(xpos, ypos, np.concatenate((inner, 8 * joins - 8)), np.concatenate((inner + 1, 8 * joins)),
+                      np.concatenate((inner // 8, joins)), widths * scale,
+                      1 if opacities is None else opacities, rgb)
+    return polylines
+
+
+def segment_pixels(ax, ay, dx, dy, reach, height, width):
+    # The pixels within reach of the segments: for every row a segment
+    # crosses, the columns around the part of the segment near the row
+    # returns the rows, the columns and the segment of every pixel
+    first = np.clip(np.floor(np.minimum(ay, ay + dy) - reach), 0, height).astype(np.int64)
+    last = np.clip(np.ceil(np.maximum(ay, ay + dy) + reach), 0, height).astype(np.int64)
+    rows, segment = expand_spans(first, np.maximum(last - first, 0))
+    centre = rows + 0.5 - ay[segment]
+    dy_row = dy[segment]
+    reach_row = reach[segment]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = np.where(dy_row != 0, (centre - reach_row) / dy_row, 0.)
+        t2 = np.where(dy_row != 0, (centre + reach_row) / dy_row, 1.)
+    t1, t2 = np.clip(np.minimum(t1, t2), 0, 1), np.clip(np.maximum(t1, t2), 0, 1)
+    x1 = ax[segment] + t1 * dx[segment]
+    x2 = ax[segment] + t2 * dx[segment]
+    left = np.clip(np.floor(np.minimum(x1, x2) - reach_row), 0, width).astype(np.int64)
+    right = np.clip(np.ceil(np.maximum(x1, x2) + reach_row), 0, width).astype(np.int64)
+    columns, span = expand_spans(left, np.maximum(right - left, 0))
+    return rows[span], columns, segment[span]
+
+
+def draw_segments(image, ax, ay, bx, by, polyline, radius, opacity, rgb):
+    # Composite the polylines, in order, onto image. The coverage of a pixel
+    # by a polyline is 1 within the stroke, fading out over the last pixel,
+    # from its distance to the nearest segment. Its opacity applies once to
+    # the whole polyline.
+    height, width = image.shape[:2]
+    dx = bx - ax
+    dy = by - ay
+    rows, columns, segment = segment_pixels(ax, ay, dx, dy, radius[polyline] + 0.5, height, width)
+    if len(rows) == 0:
+        return
+
+    # distance of the pixel centres to their segment
+    px = columns + 0.5 - ax[segment]
+    py = rows + 0.5 - ay[segment]
+    sx = dx[segment]
+    sy = dy[segment]
+    length2 = sx * sx + sy * sy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(np.where(length2 > 0, (px * sx + py * sy) / length2, 0.), 0, 1)
+    owner = polyline[segment]
+    coverage = np.clip(radius[owner] + 0.5 - np.hypot(px - t * sx, py - t * sy), 0, 1)
+    pixels = rows * width + columns
+    visible = coverage > 0
+    pixels, owner, coverage = pixels[visible], owner[visible], coverage[visible]
+
+    # every pixel of a polyline gets its largest coverage, then the
+    # polylines covering a pixel are taken in drawing order
+    first_owner = owner.min()
+    key = pixels * (owner.max() - first_owner + 1) + (owner - first_owner)
+    order = np.argsort(key)
+    key, owner, coverage = key[order], owner[order], coverage[order]
+    unique = np.flatnonzero(np.append(True, key[1:] != key[:-1]))
+    coverage = np.maximum.reduceat(coverage, unique)
+    owner = owner[unique]
+    pixels = pixels[order[unique]]
+
+    # Drawing polylines of alpha a_j and colour c_j over a pixel p gives
+    # p * prod(1 - a_j) + sum(c_j * a_j * prod over the later k (1 - a_k)),
+    # the products are sums of logarithms within each pixel
+    alpha = opacity[owner] * coverage
+    logs = np.log(np.maximum(1 - alpha, 1e-12))
+    starts = np.flatnonzero(np.append(True, pixels[1:] != pixels[:-1]))
+    total = np.add.reduceat(logs, starts)
+    group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(pixels))))
+    cumulative = np.cumsum(logs)
+    before = np.append(0., cumulative)[starts][group]
+    later = np.exp(total[group] - (cumulative - before))
+    drawn = np.add.reduceat(rgb[owner] * (alpha * later)[:, None], starts)
+
+    flat = image.reshape(-1, 3)
+    pixels = pixels[starts]
+    flat[pixels] = flat[pixels] * np.exp(total)[:, None] + drawn
+
+
+def draw_polylines(image, polylines):
+    # Draws the polylines in chunks of about chunk_pixels pixels, split
+    # between polylines
+    arrays = polylines.arrays()
+    if arrays is None:
+        return
+    ax, ay, bx, by, polyline, radius, opacity, rgb = arrays
+    reach = radius[polyline] + 0.5
+    dx = np.abs(bx - ax)
+    dy = np.abs(by - ay)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_row = np.minimum(dx, np.where(dy > 0, 2 * reach * dx / dy, dx)) + 2 * reach + 2
+    estimate = np.cumsum((dy + 2 * reach + 1) * per_row)
+    boundaries = np.flatnonzero(np.append(True, polyline[1:] != polyline[:-1]))
+    start = 0
+    while start < len(ax):
+        limit = (estimate[start - 1] if start else 0) + chunk_pixels
+        end = boundaries[np.searchsorted(boundaries, np.searchsorted(estimate, limit), side='right') - 1]
+        if end <= start:
+            # a single polyline larger than a chunk
+            following = np.searchsorted(boundaries, start, side='right')
+            end = boundaries[following] if following < len(boundaries) else len(ax)
+        draw_segments(image, ax[start:end], ay[start:end], bx[start:end], by[start:end],
+                      polyline[start:end], radius, opacity, rgb)
+        start = end
+
+
+def rasterize_page(page, width=default_x_width, coloured_annotations=False):
+    # Render a parsed page to an RGB image width pixels wide
+    # returns a (height, width, 3) uint8 array
+    scale = width / default_x_width
+    height = int(round(default_y_width * scale))
+    image = np.ones((height, width, 3), dtype=np.float32)
+    draw_polylines(image, page_polylines(page, scale, coloured_annotations))
+    return (image * 255 + 0.5).astype(np.uint8)
+
+
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def write_png(image, output, level=6):
+    # Write an RGB uint8 image to a file name or a binary file object
+    height, width = image.shape[:2]
+    # every row starts with its filter type, 0 (none)
+    rows = np.zeros((height, 1 + 3 * width), dtype=np.uint8)
+    rows[:, 1:] = image.reshape(height, 3 * width)
+    data = b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        png_chunk(b'IDAT', zlib.compress(rows.tobytes(), level)),
+        png_chunk(b'IEND', b''),
+    ))
+    if isinstance(output, (str, bytes, os.PathLike)):
+        with open(output, 'wb') as f:
+            f.write(data)
+    else:
+        output.write(data)
+
+
+def rm2png(input_file, output, coloured_annotations=False, width=default_x_width):
+    write_png(rasterize_page(load_page(input_file), width, coloured_annotations), output)
+
+
+def batch2png(input_files, output_prefix, coloured_annotations=False, width=default_x_width, jobs=1):
+    # Converts every page to its own PNG, output_prefix followed by the
+    # name of the page
+    # returns the PNG files written
+    outputs = [output_prefix + os.path.splitext(os.path.basename(input_file))[0] + '.png'
+               for input_file in input_files]
+    convert = functools.partial(convert_or_skip, functools.partial(
+        rm2png, coloured_annotations=coloured_annotations, width=width))
+    if jobs <= 1:
+        return [output for output in map(convert, input_files, outputs) if output]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return [output for output in executor.map(convert, input_files, outputs, chunksize=8) if output]
+
+
+if __name__ == "__main__":
+    main()
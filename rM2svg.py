@@ -16,15 +16,29 @@
 #          4 bytes integer: colour
 #          4 bytes: unknown
 #          4 bytes floating point: width
+#          4 bytes: unknown (version 5 only)
 #          4 bytes integer: number of segments
 #          for each segment:
 #              6 floating point numbers: x, y, pressure, title, unknown, unknown
 #
+# The version is read from the header, version 5 (firmware 2.x) only adds
+# a field to the strokes. Other versions raise FormatError.
 #
+import io
 import sys
+import glob
+import json
+import math
+import mmap
+import re
+import collections
 import struct
 import os.path
 import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 
 __prog_name__ = "rm2svg"
@@ -35,6 +49,11 @@ __version__ = "0.0.2"
 default_x_width = 1404
 default_y_width = 1872
 
+# Optimised output: simplification tolerance and precision of the path data,
+# in pixels
+default_tolerance = 0.25
+path_scale = 10
+
 # Mappings
 stroke_colour={
     0 : "black",
@@ -60,14 +79,14 @@ def main():
                         default=default_x_width)
     parser.add_argument("-i",
                         "--input",
-                        help=".rm input file",
+                        help=".rm input file, or a document directory or a quoted glob of .rm files to convert all their pages",
                         required=True,
                         metavar="FILENAME",
                         #type=argparse.FileType('r')
                         )
     parser.add_argument("-o",
                         "--output",
-                        help="prefix for output files",
+                        help="output file, prefix of the output files of the pages of a document",
                         required=True,
                         metavar="NAME",
                         #type=argparse.FileType('w')
@@ -77,16 +96,47 @@ def main():
                         help="Colour annotations for document markup.",
                         action='store_true',
                         )
+    parser.add_argument("-O",
+                        "--optimise",
+                        help="Write a smaller SVG: simplified strokes, shared styles, relative path data.",
+                        action='store_true',
+                        )
+    parser.add_argument('--tolerance',
+                        help='Largest distance a simplified stroke may move from the original, in pixels (with --optimise)',
+                        type=float,
+                        default=default_tolerance)
+    parser.add_argument("-p",
+                        "--paged",
+                        help="Write all the pages in a single SVG, flipped with goToPage.",
+                        action='store_true',
+                        )
+    parser.add_argument("-j",
+                        "--jobs",
+                        help="number of pages converted in parallel",
+                        type=int,
+                        default=1)
     parser.add_argument('--version',
                         action='version',
                         version='%(prog)s {version}'.format(version=__version__))
     args = parser.parse_args()
 
-    if not os.path.exists(args.input):
-        parser.error('The file "{}" does not exist!'.format(args.input))
+    if os.path.isfile(args.input) and not args.paged:
+        try:
+            rm2svg(args.input, args.output, args.coloured_annotations,
+                   args.width, args.height, args.optimise, args.tolerance)
+        except FormatError as error:
+            abort(str(error))
+        return
 
-    rm2svg(args.input, args.output, args.coloured_annotations,
-           args.width, args.height)
+    input_files = input_pages(args.input)
+    if not input_files:
+        parser.error('No .rm files found for "{}"!'.format(args.input))
+    if args.paged:
+        pages2svg(input_files, args.output, args.coloured_annotations,
+                  args.width, args.height, args.optimise, args.tolerance, args.jobs)
+    else:
+        batch2svg(input_files, args.output, args.coloured_annotations,
+                  args.width, args.height, args.optimise, args.tolerance, args.jobs)
 
 
 def abort(msg):
@@ -94,37 +144,452 @@ def abort(msg):
     sys.exit(1)
 
 
-def rm2svg(input_file, output_name, coloured_annotations=False,
-           x_width=default_x_width, y_width=default_y_width):
-    
+class FormatError(ValueError):
+    # A .rm file that cannot be parsed: not a .lines file, a version
+    # without a decoder or a truncated file
+    pass
+
+
+def read_segments(data, offset, nsegments):
+    # View the segment block of a stroke as a (nsegments, 6) float32 array,
+    # columns: x, y, pressure, tilt, unknown, unknown
+    segments = np.frombuffer(data, dtype='<f4', count=6 * nsegments, offset=offset)
+    return segments.reshape(nsegments, 6)
+
+
+def scale_points(segments, x_width, y_width):
+    # Rescale the device coordinates to the requested image size
+    xpos = segments[:, 0].astype(np.float64)
+    ypos = segments[:, 1].astype(np.float64)
+    ratio = (y_width/x_width)/(1872/1404)
+    if ratio > 1:
+        xpos = ratio*((xpos*x_width)/1404)
+        ypos = (ypos*y_width)/1872
+    else:
+        xpos = (xpos*x_width)/1404
+        ypos = (1/ratio)*(ypos*y_width)/1872
+    return xpos, ypos
+
+
+def pen_style(pen, colour, width, coloured_annotations=False):
+    # Returns the colour, width and opacity of a whole stroke
+    opacity = 1
+    if pen == 0 or pen == 1:
+        pass # Dynamic width, will be truncated into several strokes
+    elif pen == 2 or pen == 4: # Pen / Fineliner
+        width = 32 * width * width - 116 * width + 107
+        width *= 2
+    elif pen == 3: # Marker
+        width = 64 * width - 112
+        opacity = 0.9
+        width *= 1.5
+    elif pen == 5: # Highlighter
+        width = 30
+        opacity = 0.2
+        if coloured_annotations:
+            colour = 3
+    elif pen == 6: # Eraser
+        opacity = 0.
+    elif pen == 7: # Pencil-Sharp
+        width = 16 * width - 27
+        opacity = 0.9
+    elif pen == 8: # Erase area
+        opacity = 0.
+    else:
+        print('Unknown pen: {}'.format(pen))
+        opacity = 0.
+
+    width /= 2.3 # adjust for transformation to A4
+    return colour, width, opacity
+
+
+def segment_styles(pen, width, segments):
+    # Width (and opacity) of each 8-segment sub-polyline of the pens with
+    # dynamic width, None for the other pens
+    if pen != 0 and pen != 1:
+        return None, None
+    pressure = segments[::8, 2].astype(np.float64)
+    tilt = segments[::8, 3].astype(np.float64)
+    if pen == 0:
+        widths = (5. * tilt) * (6. * width - 10) * (1 + 2. * pressure * pressure * pressure)
+        return widths, None
+    widths = (10. * tilt - 2) * (8. * width - 14)
+    opacities = (pressure - .2) * (pressure - .2)
+    return widths, opacities
+
+
+def format_points(xpos, ypos):
+    # Format the points of a polyline as "x,y x,y ... " in a single call
+    xy = np.empty(2 * len(xpos))
+    xy[0::2] = xpos
+    xy[1::2] = ypos
+    return ('{:.3f},{:.3f} ' * len(xpos)).format(*xy.tolist())
+
+
+def simplify(xpos, ypos, tolerance):
+    # Ramer-Douglas-Peucker: drop the points closer than tolerance to the
+    # line through the points kept around them
+    n = len(xpos)
+    if n < 3 or tolerance <= 0:
+        return xpos, ypos
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx = xpos[last] - xpos[first]
+        dy = ypos[last] - ypos[first]
+        px = xpos[first + 1:last] - xpos[first]
+        py = ypos[first + 1:last] - ypos[first]
+        norm = math.hypot(dx, dy)
+        if norm == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(px * dy - py * dx) / norm
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            i += first + 1
+            keep[i] = True
+            stack.append((first, i))
+            stack.append((i, last))
+    return xpos[keep], ypos[keep]
+
+
+def format_path_data(xpos, ypos):
+    # Format a polyline as SVG path data "Mx ylx y...", the first point
+    # absolute and the others relative, rounded to 1/path_scale pixel.
+    # The offsets are taken between rounded points so that the rounding
+    # errors do not add up, points rounded onto the previous one are left
+    # out.
+    x = np.rint(xpos * path_scale).astype(np.int64)
+    y = np.rint(ypos * path_scale).astype(np.int64)
+    dx = np.diff(x)
+    dy = np.diff(y)
+    moved = (dx != 0) | (dy != 0)
+    dxy = np.empty(2 * int(moved.sum()))
+    dxy[0::2] = dx[moved]
+    dxy[1::2] = dy[moved]
+    dxy /= path_scale
+    data = 'M{:g} {:g}'.format(x[0] / path_scale, y[0] / path_scale)
+    if len(dxy):
+        data += 'l' + ('{:g} ' * len(dxy)).format(*dxy.tolist())[:-1].replace(' -', '-')
+    return data
+
+
+class Stroke:
+    # A stroke keeps its segments as a view on the bytes of the .rm file
+    __slots__ = ('pen', 'colour', 'width', 'segments')
+
+    def __init__(self, pen, colour, width, segments):
+        self.pen = pen
+        self.colour = colour
+        self.width = width
+        self.segments = segments
+
+
+class Layer:
+    __slots__ = ('strokes',)
+
+    def __init__(self, strokes=None):
+        self.strokes = strokes if strokes is not None else []
+
+
+class Page:
+    __slots__ = ('layers', 'version')
+
+    def __init__(self, layers=None, version=None):
+        self.layers = layers if layers is not None else []
+        self.version = version
+
+    def strokes(self):
+        for layer in self.layers:
+            yield from layer.strokes
+
+
+def map_file(input_file):
+    # The content of a file, mapped in memory instead of read into a copy
+    with open(input_file, 'rb') as f:
+        try:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            # an empty file cannot be mapped
+            return memoryview(b'')
+
+
+# The header is padded with spaces to header_size bytes
+header_size = 43
+header_pattern = re.compile(rb'reMarkable \.lines file, version=(\d+) *$')
+
+# Stroke header of every supported version: pen, colour, unknown, width,
+# (unknown,) number of segments
+stroke_formats = {
+    3: struct.Struct('<IIIfI'),
+    5: struct.Struct('<IIIfII'),
+}
+
+
+def lines_version(data):
+    # The version of the .lines file in data
+    match = header_pattern.match(bytes(data[:header_size]))
+    if match is None:
+        raise FormatError('Not a reMarkable .lines file')
+    return int(match.group(1))
+
+
+def parse_page(data):
+    # Parse the content of a .rm file (bytes, or a memoryview of a mapped
+    # file). The segments of the strokes are views on data, nothing is
+    # copied.
+    version = lines_version(data)
+    if version not in stroke_formats:
+        raise FormatError('Unsupported .lines version {}'.format(version))
+    stroke_format = stroke_formats[version]
+    try:
+        offset = header_size
+        (nlayers,) = struct.unpack_from('<I', data, offset); offset += 4
+        if nlayers < 1:
+            raise FormatError('Not a valid reMarkable file: <nlayers={}>'.format(nlayers))
+        page = Page(version=version)
+        for layer in range(nlayers):
+            (nstrokes,) = struct.unpack_from('<I', data, offset); offset += 4
+            strokes = []
+            for stroke in range(nstrokes):
+                fields = stroke_format.unpack_from(data, offset); offset += stroke_format.size
+                pen, colour, width, nsegments = fields[0], fields[1], fields[3], fields[-1]
+                if offset + 24 * nsegments > len(data):
+                    raise struct.error('segments past the end of the data')
+                segments = read_segments(data, offset, nsegments); offset += 24 * nsegments
+                strokes.append(Stroke(pen, colour, width, segments))
+            page.layers.append(Layer(strokes))
+    except struct.error:
+        raise FormatError('Truncated .lines file') from None
+    return page
+
+
+def load_page(input_file, data=None):
+    # Parse a .rm file once, the returned page can be rendered several times.
+    # The segments of the strokes are views on data, the content of the file
+    # when it was already read, or on the mapped file.
+    # Raises FormatError when the file cannot be parsed.
+    try:
+        return parse_page(map_file(input_file) if data is None else data)
+    except FormatError as error:
+        raise FormatError('{}: {}'.format(input_file, error)) from None
+
+
+def load_page_or_blank(input_file):
+    # A page that cannot be parsed is left blank, with a warning, so that
+    # the other pages of a document are still converted
+    try:
+        return load_page(input_file)
+    except FormatError as error:
+        print('Skipping page: {}'.format(error), file=sys.stderr)
+        return Page()
+
+
+class PageCache:
+    # Keeps the most recently parsed pages, a page is parsed again only when
+    # its file changed on disk
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.pages = collections.OrderedDict()
+
+    def get(self, input_file):
+        st = os.stat(input_file)
+        key = os.path.abspath(input_file)
+        stamp = (st.st_mtime_ns, st.st_size)
+        entry = self.pages.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.pages.move_to_end(key)
+            return entry[1]
+        # the cached pages are views on a copy of their file, a mapping would
+        # keep a file descriptor open for every page
+        with open(input_file, 'rb') as f:
+            page = load_page(input_file, f.read())
+        self.pages[key] = (stamp, page)
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.maxsize:
+            self.pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        self.pages.clear()
+
+
+page_cache = PageCache()
+
+
+def stroke_colours(coloured_annotations=False):
     if coloured_annotations:
-        global stroke_colour
-        stroke_colour = {
+        return {
             0: "blue",
             1: "red",
             2: "white",
             3: "yellow"
         }
+    return stroke_colour
 
-    # Read the file in memory. Consider optimising by reading chunks.
-    with open(input_file, 'rb') as f:
-        data = f.read()
-    offset = 0
-
-    # Is this a reMarkable .lines file?
-    expected_header=b'reMarkable .lines file, version=3          '
-    if len(data) < len(expected_header) + 4:
-        abort('File too short to be a valid file')
-
-    fmt = '<{}sI'.format(len(expected_header))
-    header, nlayers = struct.unpack_from(fmt, data, offset); offset += struct.calcsize(fmt)
-    # print('header={} nlayers={}'.format(header, nlayers))
-    if header != expected_header or nlayers < 1:
-        abort('Not a valid reMarkable file: <header={}> <nlayers={}'.format(header, nlayers))
-
-    output = open(output_name, 'w')
-    output.write('<svg xmlns="http://www.w3.org/2000/svg" height="{}" width="{}">'.format(y_width, x_width)) # BEGIN Notebook
-    output.write('''
+
+class SVGWriter:
+    # Collects the output and writes it in chunks of about chunk_size
+    # characters, to a file name or to a text or binary file object (a
+    # binary sink gets ASCII bytes)
+    def __init__(self, output, chunk_size=1 << 16):
+        self.owned = isinstance(output, (str, bytes, os.PathLike))
+        self.output = open(output, 'w') if self.owned else output
+        self.binary = not isinstance(self.output, io.TextIOBase)
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        chunk = ''.join(self.parts)
+        self.output.write(chunk.encode('ascii') if self.binary else chunk)
+        self.parts = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        if self.owned:
+            self.output.close()
+
+
+def stroke_elements(page, coloured_annotations=False,
+                    x_width=default_x_width, y_width=default_y_width):
+    # The <polyline> elements of every stroke of the page, one string per
+    # stroke
+    colours = stroke_colours(coloured_annotations)
+
+    # Iterate through the strokes of all the layers on the page
+    for stroke in page.strokes():
+        segments = stroke.segments
+        colour, width, opacity = pen_style(stroke.pen, stroke.colour, stroke.width, coloured_annotations)
+        xpos, ypos = scale_points(segments, x_width, y_width)
+        widths, opacities = segment_styles(stroke.pen, width, segments)
+
+        stroke_svg = ['<polyline style="fill:none;stroke:{};stroke-width:{:.3f};opacity:{}" points="'.format(colours[colour], width, opacity)] # BEGIN stroke
+        if widths is None:
+            stroke_svg.append(format_points(xpos, ypos))
+        else:
+            # Dynamic width, one sub-polyline every 8 segments. All the
+            # points are formatted at once, then shared out.
+            points = format_points(xpos, ypos).split(' ')[:-1]
+            for i, segment_width in enumerate(widths.tolist()):
+                start = 8 * i
+                if opacities is None:
+                    stroke_svg.append('" />\n<polyline style="fill:none;stroke:{};stroke-width:{:.3f}" points="'.format(
+                                      colours[colour], segment_width)) # UPDATE stroke
+                else:
+                    stroke_svg.append('" /><polyline style="fill:none;stroke:{};stroke-width:{:.3f};opacity:{:.3f}" points="'.format(
+                                      colours[colour], segment_width, opacities[i])) # UPDATE stroke
+                if i > 0 and xpos[start - 8] != -1.:
+                    stroke_svg.append(points[start - 8] + ' ') # Join to previous segment
+                stroke_svg.append(' '.join(points[start:start + 8]) + ' ')
+        stroke_svg.append('" />\n') # END stroke
+        yield ''.join(stroke_svg)
+
+
+def optimised_classes(pages, coloured_annotations=False):
+    # The CSS classes of the optimised output of the pages, one per colour,
+    # width and opacity of the strokes that can be seen (not the erasers).
+    # The strokes with a dynamic width share a class per colour.
+    # returns a dictionary (colour, width, opacity) -> class name
+    colours = stroke_colours(coloured_annotations)
+    classes = {}
+    for stroke in (stroke for page in pages for stroke in page.strokes()):
+        colour, width, opacity = pen_style(stroke.pen, stroke.colour, stroke.width, coloured_annotations)
+        if opacity == 0 or len(stroke.segments) < 2:
+            continue
+        if stroke.pen == 0 or stroke.pen == 1:
+            key = (colours[colour], None, None)
+        else:
+            key = (colours[colour], '{:.3g}'.format(width), '{:.3g}'.format(opacity))
+        if key not in classes:
+            classes[key] = 's{}'.format(len(classes))
+    return classes
+
+
+def optimised_style(classes):
+    rules = []
+    for (colour, width, opacity), name in classes.items():
+        rule = 'fill:none;stroke:{}'.format(colour)
+        if width is not None:
+            rule += ';stroke-width:{}'.format(width)
+        if opacity is not None and opacity != '1':
+            rule += ';opacity:{}'.format(opacity)
+        rules.append('.{}{{{}}}'.format(name, rule))
+    return '<style>{}</style>\n'.format(''.join(rules))
+
+
+def optimised_elements(page, classes, coloured_annotations=False, x_width=default_x_width,
+                       y_width=default_y_width, tolerance=default_tolerance):
+    # The strokes of a page as simplified <path> elements of the classes,
+    # one string per stroke
+    colours = stroke_colours(coloured_annotations)
+    for stroke in page.strokes():
+        segments = stroke.segments
+        colour, width, opacity = pen_style(stroke.pen, stroke.colour, stroke.width, coloured_annotations)
+        if opacity == 0 or len(segments) < 2:
+            continue
+        xpos, ypos = scale_points(segments, x_width, y_width)
+        widths, opacities = segment_styles(stroke.pen, width, segments)
+
+        if widths is None:
+            name = classes[(colours[colour], '{:.3g}'.format(width), '{:.3g}'.format(opacity))]
+            yield '<path class="{}" d="{}"/>\n'.format(name, format_path_data(*simplify(xpos, ypos, tolerance)))
+            continue
+        # Dynamic width, one sub-path every 8 segments joined to the
+        # previous one as in stroke_elements, the widths (and opacities)
+        # are attributes of the sub-paths
+        name = classes[(colours[colour], None, None)]
+        paths = []
+        for i, segment_width in enumerate(widths.tolist()):
+            start = 8 * i
+            if opacities is not None and round(opacities[i], 3) == 0:
+                continue
+            sub_x = xpos[start:start + 8]
+            sub_y = ypos[start:start + 8]
+            if i > 0 and xpos[start - 8] != -1.:
+                sub_x = np.concatenate((xpos[start - 8:start - 7], sub_x))
+                sub_y = np.concatenate((ypos[start - 8:start - 7], sub_y))
+            if len(sub_x) < 2:
+                continue
+            attributes = 'stroke-width="{:.3g}"'.format(segment_width)
+            if opacities is not None:
+                attributes += ' opacity="{:.3g}"'.format(opacities[i])
+            paths.append('<path class="{}" {} d="{}"/>\n'.format(
+                name, attributes, format_path_data(*simplify(sub_x, sub_y, tolerance))))
+        yield ''.join(paths)
+
+
+def page_elements(page, coloured_annotations=False, x_width=default_x_width, y_width=default_y_width,
+                  optimise=False, tolerance=default_tolerance, classes=None):
+    if optimise:
+        return optimised_elements(page, classes, coloured_annotations, x_width, y_width, tolerance)
+    return stroke_elements(page, coloured_annotations, x_width, y_width)
+
+
+def page_elements_job(input_file, coloured_annotations, x_width, y_width, optimise, tolerance, classes):
+    # Renders a page in a worker process
+    # returns the elements of the page joined
+    return ''.join(page_elements(load_page_or_blank(input_file), coloured_annotations, x_width, y_width,
+                                 optimise, tolerance, classes))
+
+
+def write_svg(writer, pages, npages, x_width=default_x_width, y_width=default_y_width, classes=None):
+    # Writes an SVG of npages pages, pages yields the elements of each page.
+    # Every page is a group shown by goToPage, clicking a page shows the
+    # next one.
+    writer.write('<svg xmlns="http://www.w3.org/2000/svg" height="{}" width="{}">'.format(y_width, x_width)) # BEGIN Notebook
+    writer.write('''
         <script type="application/ecmascript"> <![CDATA[
             var visiblePage = 'p1';
             function goToPage(page) {
@@ -135,98 +600,127 @@ def rm2svg(input_file, output_name, coloured_annotations=False,
         ]]> </script>
     ''')
 
+    if classes is not None:
+        # the classes are collected first, the <style> comes before the
+        # strokes
+        writer.write(optimised_style(classes))
+
     # Iterate through pages (There is at least one)
-    output.write('<g id="p1" style="display:inline">')
-    
-    # Iterate through layers on the page (There is at least one)
-    for layer in range(nlayers):
-        # print('New layer')
-        fmt = '<I'
-        (nstrokes,) = struct.unpack_from(fmt, data, offset); offset += struct.calcsize(fmt)
-
-        # print('nstrokes={}'.format(nstrokes))
-        # Iterate through the strokes in the layer (If there is any)
-        for stroke in range(nstrokes):
-            fmt = '<IIIfI'
-            pen, colour, i_unk, width, nsegments = struct.unpack_from(fmt, data, offset); offset += struct.calcsize(fmt)
-            # print('pen={} colour={} i_unk={} width={} nsegments={}'.format(pen,colour,i_unk,width,nsegments))
-            opacity = 1
-            last_x = -1.; last_y = -1.
-            #if i_unk != 0: # No theory on that one
-                #print('Unexpected value at offset {}'.format(offset - 12))
-            if pen == 0 or pen == 1:
-                pass # Dynamic width, will be truncated into several strokes
-            elif pen == 2 or pen == 4: # Pen / Fineliner
-                width = 32 * width * width - 116 * width + 107
-                width *= 2
-            elif pen == 3: # Marker
-                width = 64 * width - 112
-                opacity = 0.9
-                width *= 1.5
-            elif pen == 5: # Highlighter
-                width = 30
-                opacity = 0.2
-                if coloured_annotations:
-                    colour = 3
-            elif pen == 6: # Eraser
-                opacity = 0.
-            elif pen == 7: # Pencil-Sharp
-                width = 16 * width - 27
-                opacity = 0.9
-            elif pen == 8: # Erase area
-                opacity = 0.
-            else: 
-                print('Unknown pen: {}'.format(pen))
-                opacity = 0.
-
-            width /= 2.3 # adjust for transformation to A4
-            
-            #print('Stroke {}: pen={}, colour={}, width={}, nsegments={}'.format(stroke, pen, colour, width, nsegments))
-            output.write('<polyline style="fill:none;stroke:{};stroke-width:{:.3f};opacity:{}" points="'.format(stroke_colour[colour], width, opacity)) # BEGIN stroke
-
-            # Iterate through the segments to form a polyline
-            for segment in range(nsegments):
-                fmt = '<ffffff'
-                xpos, ypos, pressure, tilt, i_unk2, j_unk2 = struct.unpack_from(fmt, data, offset); offset += struct.calcsize(fmt)
-                # print('(x,y)=({},{})'.format(xpos,ypos))
-                #xpos += 60
-                #ypos -= 20
-                ratio = (y_width/x_width)/(1872/1404)
-                if ratio > 1:
-                    xpos = ratio*((xpos*x_width)/1404)
-                    ypos = (ypos*y_width)/1872
-                else:
-                    xpos = (xpos*x_width)/1404
-                    ypos = (1/ratio)*(ypos*y_width)/1872
-                if pen == 0:
-                    if 0 == segment % 8:
-                        segment_width = (5. * tilt) * (6. * width - 10) * (1 + 2. * pressure * pressure * pressure)
-                        #print('    width={}'.format(segment_width))
-                        output.write('" />\n<polyline style="fill:none;stroke:{};stroke-width:{:.3f}" points="'.format(
-                                    stroke_colour[colour], segment_width)) # UPDATE stroke
-                        if last_x != -1.:
-                            output.write('{:.3f},{:.3f} '.format(last_x, last_y)) # Join to previous segment
-                        last_x = xpos; last_y = ypos
-                elif pen == 1:
-                    if 0 == segment % 8:
-                        segment_width = (10. * tilt -2) * (8. * width - 14)
-                        segment_opacity = (pressure - .2) * (pressure - .2)
-                        #print('    width={}, opacity={}'.format(segment_width, segment_opacity))
-                        output.write('" /><polyline style="fill:none;stroke:{};stroke-width:{:.3f};opacity:{:.3f}" points="'.format(
-                                    stroke_colour[colour], segment_width, segment_opacity)) # UPDATE stroke
-                        if last_x != -1.:
-                            output.write('{:.3f},{:.3f} '.format(last_x, last_y)) # Join to previous segment
-                        last_x = xpos; last_y = ypos
-
-                output.write('{:.3f},{:.3f} '.format(xpos, ypos)) # BEGIN and END polyline segment
-
-            output.write('" />\n') # END stroke
-
-    # Overlay the page with a clickable rect to flip pages
-    output.write('<rect x="0" y="0" width="{}" height="{}" fill-opacity="0"/>'.format(x_width, y_width))
-    output.write('</g>') # Closing page group
-    output.write('</svg>') # END notebook
-    output.close()
+    for number, elements in enumerate(pages, 1):
+        writer.write('<g id="p{}" style="display:{}">'.format(number, 'inline' if number == 1 else 'none'))
+        for element in elements:
+            writer.write(element)
+
+        # Overlay the page with a clickable rect to flip pages
+        if npages > 1:
+            writer.write('<rect x="0" y="0" width="{}" height="{}" fill-opacity="0" onclick="goToPage(\'p{}\')"/>'.format(
+                         x_width, y_width, number % npages + 1))
+        else:
+            writer.write('<rect x="0" y="0" width="{}" height="{}" fill-opacity="0"/>'.format(x_width, y_width))
+        writer.write('</g>') # Closing page group
+    writer.write('</svg>') # END notebook
+
+
+def page2svg(page, output, coloured_annotations=False,
+             x_width=default_x_width, y_width=default_y_width,
+             optimise=False, tolerance=default_tolerance):
+    # output is a file name or a text or binary file object, a file object
+    # is left open
+    classes = optimised_classes([page], coloured_annotations) if optimise else None
+    writer = SVGWriter(output)
+    write_svg(writer, [page_elements(page, coloured_annotations, x_width, y_width, optimise, tolerance, classes)],
+              1, x_width, y_width, classes)
+    writer.close()
+
+
+def rm2svg(input_file, output, coloured_annotations=False,
+           x_width=default_x_width, y_width=default_y_width,
+           optimise=False, tolerance=default_tolerance):
+    page2svg(load_page(input_file), output, coloured_annotations,
+             x_width, y_width, optimise, tolerance)
+
+
+def document_order(directory):
+    # Position of every page in the .content file next to a document
+    # directory, newer firmwares name the pages by UUID
+    try:
+        with open(directory.rstrip('/' + os.sep) + '.content') as f:
+            pages = json.load(f).get('pages') or []
+    except (OSError, ValueError):
+        return {}
+    return {page: n for n, page in enumerate(pages)}
+
+
+def input_pages(path):
+    # The .rm files of a document directory in page order, or the .rm files
+    # matching a glob in the order of their page numbers
+    if os.path.isdir(path):
+        input_files = glob.glob(os.path.join(glob.escape(path), '*.rm'))
+        order = document_order(path)
+    else:
+        input_files = glob.glob(path)
+        order = {}
+
+    def page_key(input_file):
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        if name in order:
+            return (0, order[name], name)
+        if name.isdigit():
+            return (1, int(name), name)
+        return (2, 0, name)
+    return sorted(input_files, key=page_key)
+
+
+def convert_or_skip(convert, input_file, output):
+    # Runs convert(input_file, output), a page that cannot be parsed is
+    # skipped with a warning
+    # returns output, None when the page was skipped
+    try:
+        convert(input_file, output)
+        return output
+    except FormatError as error:
+        print('Skipping page: {}'.format(error), file=sys.stderr)
+        return None
+
+
+def batch2svg(input_files, output_prefix, coloured_annotations=False,
+              x_width=default_x_width, y_width=default_y_width,
+              optimise=False, tolerance=default_tolerance, jobs=1):
+    # Converts every page to its own SVG, output_prefix followed by the
+    # name of the page
+    # returns the SVG files written
+    outputs = [output_prefix + os.path.splitext(os.path.basename(input_file))[0] + '.svg'
+               for input_file in input_files]
+    convert = functools.partial(convert_or_skip, functools.partial(
+        rm2svg, coloured_annotations=coloured_annotations, x_width=x_width,
+        y_width=y_width, optimise=optimise, tolerance=tolerance))
+    if jobs <= 1:
+        return [output for output in map(convert, input_files, outputs) if output]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return [output for output in executor.map(convert, input_files, outputs, chunksize=4) if output]
+
+
+def pages2svg(input_files, output, coloured_annotations=False,
+              x_width=default_x_width, y_width=default_y_width,
+              optimise=False, tolerance=default_tolerance, jobs=1):
+    # Converts the pages to a single SVG with one group per page, the
+    # pages are rendered in parallel with jobs > 1 and written in order
+    classes = None
+    if optimise:
+        classes = optimised_classes((load_page_or_blank(input_file) for input_file in input_files),
+                                    coloured_annotations)
+    writer = SVGWriter(output)
+    if jobs <= 1:
+        pages = (page_elements(load_page_or_blank(input_file), coloured_annotations, x_width, y_width,
+                               optimise, tolerance, classes) for input_file in input_files)
+        write_svg(writer, pages, len(input_files), x_width, y_width, classes)
+    else:
+        n = len(input_files)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pages = executor.map(page_elements_job, input_files, [coloured_annotations] * n, [x_width] * n,
+                                 [y_width] * n, [optimise] * n, [tolerance] * n, [classes] * n)
+            write_svg(writer, ([elements] for elements in pages), n, x_width, y_width, classes)
+    writer.close()
 
 if __name__ == "__main__":
     main()
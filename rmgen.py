@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# Generator of synthetic reMarkable data, for the benchmarks.
+#
+# linesFile() builds a v3 or v5 .lines file (see rM2svg.py for the format) with a
+# given number of layers, strokes per layer and segments per stroke, drawn
+# with a mix of pens. makeTree() builds a whole backup directory: a xochitl
+# folder with nested folders, annotated PDFs and notebooks, each with their
+# .metadata, .content and .pagedata files, as downloaded from the device.
+#
+import os
+import json
+import uuid
+import random
+import struct
+from argparse import ArgumentParser
+
+from rM2svg import default_x_width, default_y_width, header_size, stroke_formats
+from rM2pdf import write_pdf, blank_page
+
+
+# pen -> weight: mostly pens and fineliners, some highlighters and
+# pencils, few erased strokes (pens as in rM2svg.pen_style)
+defaultPens = {
+    2: 4,  # pen
+    4: 4,  # fineliner
+    5: 2,  # highlighter
+    0: 1,  # brush, dynamic width
+    1: 1,  # pencil, dynamic width
+    7: 1,  # sharp pencil
+    3: 1,  # marker
+    6: 1,  # eraser
+}
+
+# Template names used for the pages of the notebooks
+defaultTemplates = ("Blank", "Lined", "Grid")
+
+
+def linesHeader(version=3):
+    return 'reMarkable .lines file, version={}'.format(version).ljust(header_size).encode('ascii')
+
+
+def linesFile(layers=1, strokes=50, segments=40, pens=None, rng=None, version=3):
+    # returns the content of a .lines file with layers * strokes strokes of
+    # segments points each, the pens are drawn from the {pen: weight} mix
+    rng = rng if rng is not None else random.Random(0)
+    pens = pens if pens is not None else defaultPens
+    choices, weights = list(pens), list(pens.values())
+    # version 5 has an extra field before the number of segments
+    extra = (0,) if version >= 5 else ()
+    out = [linesHeader(version), struct.pack('<I', layers)]
+    for layer in range(layers):
+        out.append(struct.pack('<I', strokes))
+        for stroke in range(strokes):
+            pen = rng.choices(choices, weights)[0]
+            out.append(stroke_formats[version].pack(pen, rng.randrange(3), 0,
+                                                    rng.choice((1.875, 2.0, 2.125)), *extra, segments))
+            # a random walk, as a hand would draw
+            x = rng.uniform(0, default_x_width)
+            y = rng.uniform(0, default_y_width)
+            for segment in range(segments):
+                x = min(max(x + rng.uniform(-8, 8), 0), default_x_width)
+                y = min(max(y + rng.uniform(-8, 8), 0), default_y_width)
+                out.append(struct.pack('<ffffff', x, y, rng.random(), rng.random(), 0, 0))
+    return b''.join(out)
+
+
+def writeLines(path, layers=1, strokes=50, segments=40, pens=None, rng=None, version=3):
+    with open(path, 'wb') as f:
+        f.write(linesFile(layers, strokes, segments, pens, rng, version))
+
+
+def writeJSON(path, value):
+    with open(path, 'w') as f:
+        json.dump(value, f)
+
+
+def writeMetadata(directory, UUID, name, parent, fType, lastModified):
+    writeJSON(os.path.join(directory, UUID + '.metadata'), {
+        "deleted": False,
+        "lastModified": str(lastModified),
+        "metadatamodified": False,
+        "modified": False,
+        "parent": parent,
+        "pinned": False,
+        "synced": True,
+        "type": fType,
+        "version": 1,
+        "visibleName": name
+    })
+
+
+def makeTree(directory, documents, folders=None, notebooks=0.5, pages=4, annotated=2,
+             layers=1, strokes=50, segments=40, pens=None, seed=0, version=3):
+    # Builds a backup directory with a xochitl folder of documents: a share
+    # of notebooks, the others PDFs of pages pages, annotated pages of each
+    # are drawn. The documents are spread over folders nested folders, by
+    # default one per 20 documents.
+    # returns the UUIDs of the documents
+    rng = random.Random(seed)
+    xochitl = os.path.join(directory, 'xochitl')
+    os.makedirs(xochitl, exist_ok=True)
+    os.makedirs(os.path.join(directory, 'templates'), exist_ok=True)
+    lastModified = 1500000000000
+
+    if folders is None:
+        folders = documents // 20
+    parents = [""]
+    for n in range(folders):
+        UUID = str(uuid.UUID(int=rng.getrandbits(128)))
+        # a random earlier folder as parent gives a tree of varying depth
+        writeMetadata(xochitl, UUID, "Folder %d" % n, rng.choice(parents), "CollectionType", lastModified)
+        writeJSON(os.path.join(xochitl, UUID + '.content'), {})
+        parents.append(UUID)
+
+    # every PDF is the same file, written once
+    basePDF = os.path.join(directory, 'base.pdf')
+    write_pdf([blank_page() for pg in range(pages)], basePDF)
+    with open(basePDF, 'rb') as f:
+        pdf = f.read()
+
+    # a small pool of pages, documents share their .rm files contents
+    pool = [linesFile(layers, strokes, segments, pens, rng, version) for n in range(16)]
+
+    UUIDs = []
+    for n in range(documents):
+        UUID = str(uuid.UUID(int=rng.getrandbits(128)))
+        isNotebook = rng.random() < notebooks
+        writeMetadata(xochitl, UUID, ("Notebook %d" if isNotebook else "Paper %d") % n,
+                      rng.choice(parents), "DocumentType", lastModified + n)
+        writeJSON(os.path.join(xochitl, UUID + '.content'),
+                  {"fileType": "notebook" if isNotebook else "pdf", "pageCount": pages})
+        with open(os.path.join(xochitl, UUID + '.pagedata'), 'w') as f:
+            if isNotebook:
+                f.write("".join(rng.choice(defaultTemplates) + "\n" for pg in range(pages)))
+        if not isNotebook:
+            with open(os.path.join(xochitl, UUID + '.pdf'), 'wb') as f:
+                f.write(pdf)
+        os.makedirs(os.path.join(xochitl, UUID), exist_ok=True)
+        for pg in sorted(rng.sample(range(pages), min(annotated, pages))):
+            with open(os.path.join(xochitl, UUID, "%d.rm" % pg), 'wb') as f:
+                f.write(rng.choice(pool))
+        UUIDs.append(UUID)
+    return UUIDs
+
+
+def main():
+    parser = ArgumentParser(description="Generate a synthetic reMarkable backup directory")
+    parser.add_argument("directory", help="backup directory to create")
+    parser.add_argument("-n", "--documents", help="number of documents", type=int, default=100)
+    parser.add_argument("--folders", help="number of folders (default: one per 20 documents)", type=int)
+    parser.add_argument("--pages", help="pages per document", type=int, default=4)
+    parser.add_argument("--annotated", help="annotated pages per document", type=int, default=2)
+    parser.add_argument("--layers", help="layers per page", type=int, default=1)
+    parser.add_argument("--strokes", help="strokes per layer", type=int, default=50)
+    parser.add_argument("--segments", help="segments per stroke", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lines_version", help="version of the .lines files: 3 or 5", type=int, default=3)
+    args = parser.parse_args()
+    makeTree(args.directory, args.documents, args.folders, pages=args.pages, annotated=args.annotated,
+             layers=args.layers, strokes=args.strokes, segments=args.segments, seed=args.seed,
+             version=args.lines_version)
+
+
+if __name__ == "__main__":
+    main()
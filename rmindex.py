@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# In-memory index of the .metadata files of a xochitl directory.
+#
+# The directory is scanned once, every .metadata file is parsed once and the
+# entries can then be looked up by UUID, by parent and by (parent, name).
+# The library path of an entry is resolved through its parents and memoized.
+#
+import os
+import json
+
+
+def loadJSON(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# Files a xochitl entry can have, '' is its page directory
+documentExtensions = ('', '.metadata', '.content', '.pagedata', '.pdf', '.epub')
+
+
+class MetadataIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}   # UUID -> metadata
+        self.files = {}     # UUID -> extensions present ('' for the page directory)
+        self.children = {}  # parent UUID -> set of UUIDs
+        self.names = {}     # (parent UUID, visibleName) -> list of UUIDs
+        self.paths = {}     # memoized library paths
+        self.scan()
+
+    def scan(self):
+        self.entries.clear()
+        self.files.clear()
+        self.children.clear()
+        self.names.clear()
+        self.paths.clear()
+        if not os.path.isdir(self.directory):
+            return
+        metadata = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                name, ext = os.path.splitext(entry.name)
+                # the page directory is recorded as '', the other
+                # directories (.cache, .thumbnails, ...) are left out
+                if (ext == '') != entry.is_dir():
+                    continue
+                self.files.setdefault(name, set()).add(ext)
+                if ext == '.metadata':
+                    metadata.append((name, entry.path))
+        for UUID, path in metadata:
+            self._insert(UUID, loadJSON(path))
+
+    def _insert(self, UUID, meta):
+        self.entries[UUID] = meta
+        self.children.setdefault(meta.get('parent', ''), set()).add(UUID)
+        self.names.setdefault((meta.get('parent', ''), meta.get('visibleName')), []).append(UUID)
+
+    def _remove(self, UUID):
+        meta = self.entries.pop(UUID)
+        self.children[meta.get('parent', '')].discard(UUID)
+        self.names[(meta.get('parent', ''), meta.get('visibleName'))].remove(UUID)
+
+    def __contains__(self, UUID):
+        return UUID in self.entries
+
+    def __getitem__(self, UUID):
+        return self.entries[UUID]
+
+    def get(self, UUID, default=None):
+        return self.entries.get(UUID, default)
+
+    def hasFile(self, UUID, ext):
+        return ext in self.files.get(UUID, ())
+
+    def documents(self):
+        # UUIDs of the documents with a page directory, in a stable order
+        return sorted(UUID for UUID in self.entries if self.hasFile(UUID, ''))
+
+    def withFile(self, ext):
+        return [UUID for UUID in self.entries if self.hasFile(UUID, ext)]
+
+    def folders(self):
+        return [UUID for UUID, meta in self.entries.items() if meta.get('type') == 'CollectionType']
+
+    def find(self, parent, name, match=None):
+        # Last entry called name in parent (accepted by match), "" if none
+        found = ""
+        for UUID in self.names.get((parent, name), ()):
+            if match is None or match(UUID):
+                found = UUID
+        return found
+
+    def findFolder(self, parent, name):
+        return self.find(parent, name, lambda UUID: self.entries[UUID].get('type') == 'CollectionType')
+
+    def findDocument(self, parent, name, ext):
+        return self.find(parent, name, lambda UUID: self.hasFile(UUID, ext))
+
+    def path(self, parent):
+        # Library path of the folder parent, "" for the root folder
+        if parent == "" or parent not in self.entries:
+            return ""
+        path = self.paths.get(parent)
+        if path is None:
+            meta = self.entries[parent]
+            path = self.path(meta['parent']) + meta['visibleName'] + "/"
+            self.paths[parent] = path
+        return path
+
+    def update(self, UUID, meta, extensions=()):
+        # Record a created or modified entry
+        if UUID in self.entries:
+            old = self.entries[UUID]
+            if old.get('parent') != meta.get('parent') or old.get('visibleName') != meta.get('visibleName'):
+                self.paths.clear()
+            self._remove(UUID)
+        self._insert(UUID, meta)
+        self.files.setdefault(UUID, set()).update(('.metadata',) + tuple(extensions))
+
+    def refresh(self, UUID):
+        # Read one entry again after its files changed on disk
+        extensions = set()
+        for ext in documentExtensions:
+            if os.path.exists(os.path.join(self.directory, UUID + ext)):
+                extensions.add(ext)
+        if UUID in self.entries:
+            if self.entries[UUID].get('type') == 'CollectionType':
+                self.paths.clear()
+            self._remove(UUID)
+        self.files.pop(UUID, None)
+        if '.metadata' not in extensions:
+            return
+        path = os.path.join(self.directory, UUID + '.metadata')
+        meta = loadJSON(path)
+        if meta.get('type') == 'CollectionType':
+            self.paths.clear()
+        self._insert(UUID, meta)
+        self.files[UUID] = extensions
+
+    def addFile(self, UUID, ext):
+        self.files.setdefault(UUID, set()).add(ext)
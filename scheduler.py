@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+#
+# Order of the exports of a sync. The changed documents are exported by
+# priority: the pinned documents first (pinned on the tablet, or given by
+# name or UUID), then the others in the chosen order:
+#   recent:  last modified on the tablet first
+#   pages:   fewest pages to render first, the most documents per second
+#   listing: by UUID, the order of the backup
+# With a time budget, documents are only started until the budget is spent,
+# the others are left as they are and exported by the next run.
+#
+import time
+
+orders = ("recent", "pages", "listing")
+
+
+class Scheduler:
+    def __init__(self, order="recent", pinned=(), budget=None):
+        if order not in orders:
+            raise ValueError("unknown export order: " + order)
+        self.order = order
+        self.pinned = set(pinned)
+        self.budget = budget
+        self.deadline = None
+        # documents left for the next run
+        self.deferred = set()
+
+    def start(self):
+        # Starts the clock of the budget
+        if self.budget is not None:
+            self.deadline = time.monotonic() + self.budget
+
+    def allows(self):
+        # returns False once the budget is spent
+        return self.deadline is None or time.monotonic() < self.deadline
+
+    def defer(self, UUID):
+        self.deferred.add(UUID)
+
+    def isPinned(self, index, UUID):
+        meta = index[UUID]
+        return bool(meta.get("pinned")) or UUID in self.pinned or meta["visibleName"] in self.pinned \
+            or index.path(meta["parent"]) + meta["visibleName"] in self.pinned
+
+    def key(self, index, UUID, pendingPages):
+        # Sort key of a document of the index, pendingPages(UUID) counts the
+        # pages it has to render and is only called by the "pages" order
+        if self.order == "recent":
+            rank = -int(index[UUID].get("lastModified", 0))
+        elif self.order == "pages":
+            rank = pendingPages(UUID)
+        else:
+            rank = 0
+        return not self.isPinned(index, UUID), rank, UUID
+
+    def sort(self, index, UUIDs, pendingPages):
+        # returns the UUIDs in the order they are exported, the ones missing
+        # from the index last
+        known = [UUID for UUID in UUIDs if UUID in index]
+        unknown = [UUID for UUID in UUIDs if UUID not in index]
+        return sorted(known, key=lambda UUID: self.key(index, UUID, pendingPages)) + unknown
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Snapshots of the backup directory, in a content-addressed store.
+#
+# blobs/:     every file content once, named by its SHA-1 (blobs/ab/cdef...),
+#             so an unchanged file costs nothing in a new snapshot. A blob
+#             is a copy of the file it was taken from, never a link: it
+#             keeps its content whatever happens to the backup, and to the
+#             restored files.
+# manifests/: one JSON file per snapshot, named by its date, mapping every
+#             file of the snapshot to (hash, size, mtime).
+#
+# A blob is kept as long as a manifest refers to it: pruning drops the
+# manifests of the old snapshots, counts the references of the blobs in the
+# ones left and removes the blobs no longer referenced.
+#
+import os
+import json
+import time
+import shutil
+
+
+class SnapshotStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.blobs = os.path.join(directory, "blobs")
+        self.manifests = os.path.join(directory, "manifests")
+
+    def blobPath(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest[2:])
+
+    def names(self):
+        # returns the names of the snapshots, oldest first
+        try:
+            files = os.listdir(self.manifests)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in files if name.endswith(".json"))
+
+    def load(self, name):
+        # returns {path: (hash, size, mtime)} of a snapshot
+        try:
+            with open(os.path.join(self.manifests, name + ".json")) as f:
+                return {path: tuple(entry) for path, entry in json.load(f)["files"].items()}
+        except FileNotFoundError:
+            raise ValueError("no snapshot " + name) from None
+
+    def read(self, entry):
+        with open(self.blobPath(entry[0]), "rb") as f:
+            return f.read()
+
+    def store(self, path, digest):
+        # Adds the content of path to the blobs, unless it is already there
+        blob = self.blobPath(digest)
+        if os.path.exists(blob):
+            return
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        temp = blob + ".{}.tmp".format(os.getpid())
+        shutil.copyfile(path, temp)
+        os.replace(temp, blob)
+
+    def take(self, directory, listing, fileHash):
+        # Snapshots the files of directory given by listing {path: (size,
+        # mtime)}, fileHash(path) returns the SHA-1 of a file
+        # returns the name of the snapshot
+        files = {}
+        for path, (size, mtime) in sorted(listing.items()):
+            digest = fileHash(os.path.join(directory, path))
+            self.store(os.path.join(directory, path), digest)
+            files[path] = (digest, size, mtime)
+        # the manifest is written last, a snapshot is only listed once all its
+        # blobs are stored
+        os.makedirs(self.manifests, exist_ok=True)
+        name = time.strftime("%Y-%m-%dT%H%M%S")
+        n = 1
+        while os.path.exists(os.path.join(self.manifests, name + ".json")):
+            n += 1
+            name = time.strftime("%Y-%m-%dT%H%M%S") + "-" + str(n)
+        temp = os.path.join(self.manifests, name + ".tmp")
+        with open(temp, "w") as f:
+            json.dump({"created": time.time(), "files": files}, f)
+        os.replace(temp, os.path.join(self.manifests, name + ".json"))
+        return name
+
+    def restore(self, name, directory, roots):
+        # Makes the folders roots of directory the same as in the snapshot:
+        # the files are copied from their blobs with their modification
+        # times, and the files not in the snapshot are removed
+        # returns the number of files restored
+        files = self.load(name)
+        for path, (digest, size, mtime) in files.items():
+            target = os.path.join(directory, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            temp = target + ".tmp"
+            shutil.copyfile(self.blobPath(digest), temp)
+            os.utime(temp, (mtime, mtime))
+            os.replace(temp, target)
+        for root in roots:
+            for parent, dirs, names in os.walk(os.path.join(directory, root), topdown=False):
+                for fileName in names:
+                    path = os.path.relpath(os.path.join(parent, fileName), directory).replace(os.sep, "/")
+                    if path not in files:
+                        os.remove(os.path.join(parent, fileName))
+                if not os.listdir(parent):
+                    os.rmdir(parent)
+        return len(files)
+
+    def diff(self, old, new):
+        # returns {path: (entry in old, entry in new)} of the files that
+        # differ, the entry is None when the file is missing
+        a, b = self.load(old), self.load(new)
+        changes = {}
+        for path in set(a) | set(b):
+            entryA, entryB = a.get(path), b.get(path)
+            if entryA is None or entryB is None or entryA[0] != entryB[0]:
+                changes[path] = (entryA, entryB)
+        return changes
+
+    def prune(self, keep):
+        # Removes all the snapshots but the keep newest ones, and the blobs
+        # they were the last to refer to
+        # returns the removed snapshots and the number of blobs removed
+        if keep < 1:
+            raise ValueError("at least the newest snapshot is kept")
+        names = self.names()
+        removed = names[:max(len(names) - keep, 0)]
+        for name in removed:
+            os.remove(os.path.join(self.manifests, name + ".json"))
+        references = {}
+        for name in self.names():
+            for digest, size, mtime in self.load(name).values():
+                references[digest] = references.get(digest, 0) + 1
+        blobs = 0
+        if os.path.isdir(self.blobs):
+            for prefix in os.listdir(self.blobs):
+                for fileName in os.listdir(os.path.join(self.blobs, prefix)):
+                    if references.get(prefix + fileName, 0) == 0:
+                        os.remove(os.path.join(self.blobs, prefix, fileName))
+                        blobs += 1
+        return removed, blobs
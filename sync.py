@@ -7,13 +7,33 @@ import shutil
 import glob
 import json
 import time
-import re
 import uuid
+import asyncio
+import threading
+import contextvars
+import hashlib
+import subprocess
+import collections
+import cProfile
+import pstats
+from concurrent.futures import ProcessPoolExecutor
 from argparse import ArgumentParser
 from PyPDF2 import PdfFileReader
+from PyPDF2.pdf import PageObject
 sys.path.append("..") # Adds higher directory to python modules path.
-from rM2svg import rm2svg 
-# needs imagemagick, pdftk
+from rM2svg import FormatError, default_x_width, default_y_width
+from rM2pdf import OverlayCache, copy_page, stamp_pdf
+from rmindex import MetadataIndex
+from syncstate import SyncState
+from transfer import (LocalTransport, RemarkableTransport, TransferError, changedPaths, documentBatches, entryOf,
+                      localListing, pull, push, recordPull)
+from watch import makeWatcher, overflowed, waitForChanges
+from upload import UploadPlan
+from metrics import Metrics
+from profiles import Profile, loadProfiles
+from scheduler import Scheduler, orders
+from snapshots import SnapshotStore
+# needs rsvg-convert (notebook templates)
 
 __prog_name__ = "sync"
 __version__ = "0.0.2"
@@ -23,10 +43,50 @@ syncDirectory = "SYNC_DIR"
 remarkablePCDirectory = "REMARKABLE_PC_BACKUP"
 remContent = "/xochitl"
 remTemplates = "/templates/"
+remOverlayCache = "/cache/overlays"
+remTemplateCache = "/cache/templates"
+remSyncState = "/sync.db"
+remSnapshots = "/snapshots"
 remarkableDirectory = "/home/root/.local/share/remarkable/xochitl"
 remarkableDirectoryTemplates = "/usr/share/remarkable/templates"
 remarkableUsername = "root"
 remarkableIP = "10.11.99.1"
+# Local directory standing in for the device (with xochitl and templates
+# folders as on the tablet), to sync without a tablet
+remarkableMirror = ""
+
+# Types of the library files that are uploaded to the device
+uploadTypes = {"pdf", "epub"}
+
+# Documents with at least this many annotated pages have their pages
+# rendered in parallel with --jobs
+largeDocumentPages = 64
+
+# The sync pulls the documents in batches of about pullBatchBytes bytes,
+# pullStreams batches at a time
+pullBatchBytes = 8 << 20
+pullStreams = 2
+
+# Order of the exports (see scheduler.py), and the documents exported
+# before the others, by name, library path or UUID. The documents pinned on
+# the tablet are always exported first.
+exportOrder = "recent"
+pinnedDocuments = []
+
+# Time spent in every stage of the run, written with --metrics
+metrics = Metrics()
+
+# Rendered pages of the exported documents, by hash of their .rm file, in
+# the cache folder of the profile. The pages used least recently are removed
+# once the cache is larger than overlayCacheBytes.
+overlayCacheBytes = 1 << 30
+overlayCaches = {}  # folder -> OverlayCache
+
+# Priorities of the exports and time budget of the run
+scheduler = Scheduler(exportOrder, pinnedDocuments)
+
+# Cores of the machine, the size of the worker pool of a multi-device sync
+defaultJobs = os.cpu_count() or 1
 
 def main():
     parser = ArgumentParser()
@@ -50,286 +110,1018 @@ def main():
                         "--dry_upload",
                         help="just print upload commands",
                         action="store_true")
+    parser.add_argument("--upload_plan",
+                        help="save the upload plan as JSON to this file",
+                        metavar="FILE")
+    parser.add_argument("-w",
+                        "--watch",
+                        help="keep running, stage new library files and export changed documents as they appear",
+                        action="store_true")
+    parser.add_argument("-j",
+                        "--jobs",
+                        help="number of documents converted in parallel (default: 1, the number of cores with --devices)",
+                        type=int)
+    parser.add_argument("--devices",
+                        help="JSON file of the devices and libraries to sync, all at the same time (see profiles.py)",
+                        metavar="FILE")
+    parser.add_argument("--order",
+                        help="order of the exports: last modified first, fewest pages to render first, or by UUID "
+                             "(default: " + exportOrder + ")",
+                        choices=orders,
+                        default=exportOrder)
+    parser.add_argument("--pin",
+                        help="export this document first, by name, library path or UUID (can be repeated)",
+                        action="append",
+                        default=[],
+                        metavar="NAME")
+    parser.add_argument("--budget",
+                        help="stop starting exports after this many seconds, the others are left for the next run",
+                        type=float,
+                        metavar="SECONDS")
+    parser.add_argument("--snapshot",
+                        help="snapshot the backup, after the other steps",
+                        action="store_true")
+    parser.add_argument("--snapshots",
+                        help="list the snapshots of the backup",
+                        action="store_true")
+    parser.add_argument("--diff",
+                        help="list the documents that differ between two snapshots",
+                        nargs=2,
+                        metavar=("OLD", "NEW"))
+    parser.add_argument("--restore",
+                        help="restore a snapshot of the backup to another folder",
+                        nargs=2,
+                        metavar=("NAME", "DIRECTORY"))
+    parser.add_argument("--prune",
+                        help="keep only the N newest snapshots",
+                        type=int,
+                        metavar="N")
+    parser.add_argument("--metrics",
+                        help="save the time spent in every stage of the run as JSON to this file",
+                        metavar="FILE")
+    parser.add_argument("--profile",
+                        help="profile the run with cProfile and save the stats to this file",
+                        metavar="FILE")
     args = parser.parse_args()
+    if args.budget is not None and args.watch:
+        parser.error("--budget bounds a single run, it can not be used with --watch")
+    if args.prune is not None and args.prune < 1:
+        parser.error("--prune keeps at least the newest snapshot")
+    if args.devices and (args.snapshots or args.diff or args.restore or args.prune is not None):
+        parser.error("--snapshots, --diff, --restore and --prune work on a single backup, "
+                     "they can not be used with --devices")
+    global scheduler
+    scheduler = Scheduler(args.order, pinnedDocuments + args.pin, args.budget)
+    profiles = [defaultProfile()]
+    if args.devices:
+        if args.watch:
+            parser.error("--watch follows a single library, it can not be used with --devices")
+        try:
+            profiles = loadProfiles(args.devices, defaultProfile().__getstate__())
+        except (OSError, ValueError) as error:
+            # missing or unreadable, not JSON, or invalid profiles
+            parser.error("--devices " + args.devices + ": " + str(error))
+    jobs = args.jobs or (defaultJobs if args.devices else 1)
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    scheduler.start()
     if args.backup:
-        downloadRM()
+        for profile in profiles:
+            useProfile(profile)
+            downloadRM()
     if args.sync:
         print("Sync in progress")
-        downloadRM()
-        convertFiles()
-        prepareUploadPDF(False)
-        prepareUploadEBUP(False)
-        loadOnRM()
-        sync = "".join(["ssh ", remarkableUsername, "@", remarkableIP, " ",  "systemctl restart xochitl" ])
-        os.system(sync)
-    if args.convert:
-        convertFiles()
-    if args.prepare_upload:
-        print("upload")
-        prepareUpload(args.dry_upload)
+        syncProfiles(profiles, jobs)
+    for profile in profiles:
+        useProfile(profile)
+        if args.convert:
+            convertFiles(jobs)
+        if args.prepare_upload:
+            print("upload")
+            prepareUpload(args.dry_upload, args.upload_plan)
+        if args.snapshot:
+            takeSnapshot()
+    # the snapshots of the single backup
+    try:
+        if args.prune is not None:
+            pruneSnapshots(args.prune)
+        if args.snapshots:
+            listSnapshots()
+        if args.diff:
+            diffSnapshots(*args.diff)
+        if args.restore:
+            if os.path.abspath(args.restore[1]) == os.path.abspath(backupDirectory()):
+                parser.error("restore to another folder, the sync state of the backup would not match the snapshot")
+            restoreSnapshot(*args.restore)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.watch:
+        watchLibrary(jobs)
+    if args.profile:
+        # the documents converted by the workers of --jobs are not profiled
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    if args.metrics:
+        metrics.dump(args.metrics)
     print("Done!")
 
-### BACK UP  (FULL) ###
+# Transport to a directory of the device, or of its local mirror
+def deviceTransport(directory):
+    profile = activeProfile()
+    if profile.remarkableMirror:
+        return LocalTransport(profile.remarkableMirror + directory)
+    return RemarkableTransport(profile.remarkableUsername, profile.remarkableIP, directory)
+
+### BACK UP  (INCREMENTAL) ###
 def downloadRM():
     print("Backing up your remarkable files")
     #Sometimes the remarkable doesnt connect properly. In that case turn off & disconnect -> turn on -> reconnect
-    backupCommand = "".join(["rclone copy -P --exclude *.{thumbnails,cache}/** ", "remarkable:", remarkableDirectory, " ", remarkablePCDirectory + remContent])
-    os.system(backupCommand)
-    backupCommandTemplates = "".join(["rclone copy -P ", "remarkable:", remarkableDirectoryTemplates, " ", remarkablePCDirectory + remTemplates])
-    os.system(backupCommandTemplates)
+    state = loadState()
+    with metrics.stage("download"):
+        try:
+            pulled = pull(deviceTransport(remarkableDirectory), backupDirectory(remContent), state, remContent)
+            print(str(len(pulled)) + " files downloaded")
+            pull(deviceTransport(remarkableDirectoryTemplates), backupDirectory(remTemplates), state, remTemplates)
+        except TransferError as error:
+            # the run goes on with the backup as it is, the files not
+            # recorded are pulled again by the next one
+            print("Backup failed: " + str(error))
+            resetIndex()
+            return
+    metrics.count("downloaded", len(pulled))
+    if pulled:
+        resetIndex()
 
-### BACK UP  (FULL) ###
+### UPLOAD  (INCREMENTAL) ###
+# returns True when files were uploaded
 def loadOnRM():
     print("Sync remarkable files")
     #Sometimes the remarkable doesnt connect properly. In that case turn off & disconnect -> turn on -> reconnect
-    backupCommand = "".join(["rclone copy -P --exclude *.{thumbnails,cache}/** ", remarkablePCDirectory + remContent, " ", "remarkable:",remarkableDirectory ])
-    os.system(backupCommand)
- 
-
-def setDirectory(parent):
-    basePath = remarkablePCDirectory + remContent + "/"
-    path = ""
-    pathArray = []
-    while parent != "":
-        meta = json.loads(open(basePath + parent + ".metadata").read())
-        pathArray.insert(0,meta["visibleName"])
-        path = meta["visibleName"] + "/" + path
-        parent = meta["parent"]
-    return path
+    with metrics.stage("push"):
+        try:
+            pushed = push(deviceTransport(remarkableDirectory), backupDirectory(remContent), loadState(), remContent)
+        except TransferError as error:
+            # the files not recorded are pushed again by the next run
+            print("Upload failed: " + str(error))
+            return False
+    print(str(len(pushed)) + " files uploaded")
+    metrics.count("uploaded", len(pushed))
+    return len(pushed) > 0
 
-### CONVERT TO PDF ###
-def convertFiles():
-    #### Get file lists
-    files = [x for x in os.listdir(remarkablePCDirectory+remContent) if "." not in x]
-    files = [x for x in files if glob.glob(remarkablePCDirectory+remContent + "/" + x + ".metadata") != [] ]
-
-    for i in range(0, len(files)):
-        # get file reference number
-        refNrPath = remarkablePCDirectory + remContent + "/" + files[i]
-        # get meta Data
-        meta = json.loads(open(refNrPath + ".metadata").read())
-        content = json.loads(open(refNrPath + ".content").read())
-        fname = meta["visibleName"]
-        # Does this lines file have an associated pdf?
-        isPDF = content["fileType"] == "pdf"
-
-        pathDirectoryFile = setDirectory(meta["parent"])
+# Reload the library on the device, needed to show the uploaded files
+def restartRM():
+    with metrics.stage("restart"):
         try:
-            os.makedirs(syncDirectory + "/" + pathDirectoryFile) # will create the directory only if it does not exist
-        except FileExistsError:
-            pass
-        
-        # Get list of all rm files i.e. all pages
-        rmPaths = glob.glob(refNrPath+"/*.rm")
-        npages = len(rmPaths)
-        
-        syncFilePath = syncDirectory + "/" + pathDirectoryFile + fname + ".pdf"
-        if npages != 0 & (not meta["deleted"]):
-            if isPDF:
-                # deal with annotated pdfs
-                # have we exported this thing before?
-                print("exporting PDF: " + fname)
-                local_annotExist = True if glob.glob(syncFilePath[:-4] + ".annot.pdf", recursive=True) != [] else False
-                remoteChanged = True
-                if local_annotExist:
-                    local_annotPath = glob.glob(syncFilePath[:-4]+".annot.pdf", recursive=True)[0]
-                    local_annot_mod_time = os.path.getmtime(local_annotPath)
-                    remote_annot_mod_time = int(meta["lastModified"])/1000 # rm time is in ms
-                    # has this version changed since we last exported it?
-                    remoteChanged = remote_annot_mod_time > local_annot_mod_time
-                if remoteChanged:
-                    # only then fo we export
-                    origPDF = refNrPath + ".pdf"
-                    # get info on origin pdf
-                    input1 = PdfFileReader(open(origPDF, "rb"))
-                    npages = input1.getNumPages() #Override pages number to maintain correspondence to the original PDF
-                    pdfsize = input1.getPage(0).mediaBox
-                    pdfx = int(pdfsize[2])
-                    pdfy = int(pdfsize[3])
-                    # export
-                    pdflist = []
-                    for pg in range(0, npages):
-                        rmpath = refNrPath+"/"+str(pg)+".rm"
-                        rmExists = True if glob.glob(rmpath) != [] else False
-                        if rmExists: # Handle annotated pdf not on every single page
-                            try:
-                                os.mkdir("temp")
-                            except:
-                                pass    
-                            rm2svg(rmpath, "temp/temprm"+str(pg)+".svg", coloured_annotations=False)
-                            convertSvg2PdfCmd = "".join(["rsvg-convert -f pdf -o ", "temp/temppdf" + str(pg), ".pdf ", "temp/temprm" + str(pg) + ".svg"])
-                            os.system(convertSvg2PdfCmd)
-                            pdflist.append("temp/temppdf"+str(pg)+".pdf")
-                        else:
-                            pdflist.append("empty.pdf")
-            
-                    merged_rm = "temp/merged_rm.pdf"
-                    os.system("pdftk "+ (" ").join(pdflist)+" cat output "+merged_rm)
-                  
-                    stampCmd = "".join(["pdftk ", "\""+origPDF+"\"", " multistamp ", merged_rm, " output ", "\""+syncFilePath[:-4]+ ".annot.pdf\""])
-                    os.system(stampCmd)
-                    # Remove temporary files
-                    shutil.rmtree("temp", ignore_errors=False, onerror=None)
-                    print("exporting done!")
-                else:
-                    print(fname + " has not changed")
+            deviceTransport(remarkableDirectory).restart()
+        except TransferError as error:
+            print("Restart failed: " + str(error))
+
+### PROFILES ###
+# Profile of the sync running in the current context, every asyncio task
+# of a multi-device sync has its own. Defaults to the settings above.
+currentProfile = contextvars.ContextVar("currentProfile", default=None)
+
+def activeProfile():
+    profile = currentProfile.get()
+    if profile is None:
+        profile = defaultProfile()
+        currentProfile.set(profile)
+    return profile
+
+def useProfile(profile):
+    currentProfile.set(profile)
+
+# The profile of the settings at the top of this file
+def defaultProfile():
+    return Profile("default", syncDirectory, remarkablePCDirectory, remarkableIP, remarkableUsername,
+                   remarkableMirror)
+
+# Folders of the active profile
+def libraryDirectory():
+    return activeProfile().syncDirectory
+
+def backupDirectory(subdirectory=""):
+    return activeProfile().remarkablePCDirectory + subdirectory
+
+# Folder of the caches (rendered pages, templates) of the active profile,
+# shared by the profiles of a --devices file. It is sent to the worker
+# processes with the profile, or with the pages they render.
+def cacheDirectory(subdirectory):
+    return activeProfile().cacheFolder() + subdirectory
+
+def overlayCache(directory):
+    if directory not in overlayCaches:
+        overlayCaches[directory] = OverlayCache(directory, lambda name: metrics.stage("convert." + name))
+    return overlayCaches[directory]
+
+# Persistent state of the sync of the active profile, opened on first use
+def loadState():
+    profile = activeProfile()
+    if profile.state is None:
+        os.makedirs(profile.remarkablePCDirectory, exist_ok=True)
+        profile.state = SyncState(profile.remarkablePCDirectory + remSyncState)
+    return profile.state
+
+# Index of the .metadata files in the backup of the active profile, built
+# on first use
+def loadIndex():
+    profile = activeProfile()
+    if profile.index is None:
+        with metrics.stage("index"):
+            profile.index = MetadataIndex(backupDirectory(remContent))
+    return profile.index
+
+# The backup changed on disk, the index has to be built again
+def resetIndex():
+    activeProfile().index = None
+
+# Template backgrounds rendered to PDF, cached on disk by template name and
+# hash of the template file, and in memory for every thread of the current
+# process: a page reads its content from the file of its reader, which the
+# threads converting large documents can not share. The profiles share the
+# pages of the templates with the same content.
+templateDigests = {}  # (path, size, mtime) -> hash of the template file
+templatePages = {}    # (name, hash, thread) -> page, None when it can not be rendered
+
+# Size in points of the rendered templates, 1404x1872 px at the 96 dpi of
+# rsvg-convert. The notebook pages without a template are blank pages of
+# the same size.
+templateWidth = default_x_width * 0.75
+templateHeight = default_y_width * 0.75
+
+def loadTemplate(name):
+    templateSVG = backupDirectory(remTemplates) + name + ".svg"
+    try:
+        st = os.stat(templateSVG)
+    except FileNotFoundError:
+        return None
+    key = (templateSVG, st.st_size, st.st_mtime_ns)
+    if key not in templateDigests:
+        with open(templateSVG, "rb") as f:
+            templateDigests[key] = hashlib.sha1(f.read()).hexdigest()
+    digest = templateDigests[key]
+    page = (name, digest, threading.get_ident())
+    if page not in templatePages:
+        templatePDF = cacheDirectory(remTemplateCache) + "/" + name + "-" + digest + ".pdf"
+        if not os.path.exists(templatePDF):
+            os.makedirs(cacheDirectory(remTemplateCache), exist_ok=True)
+            tempPDF = templatePDF + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+            with metrics.stage("convert.templates"):
+                try:
+                    rendered = subprocess.call(["rsvg-convert", "-f", "pdf", "-o", tempPDF, templateSVG]) == 0
+                except FileNotFoundError:
+                    print("rsvg-convert not found, the notebooks are exported without their templates")
+                    rendered = False
+            if not rendered:
+                # not tried again by this process
+                if os.path.exists(tempPDF):
+                    os.remove(tempPDF)
+                templatePages[page] = None
+                return None
+            os.replace(tempPDF, templatePDF)
+        templatePages[page] = PdfFileReader(open(templatePDF, "rb")).getPage(0)
+    return templatePages[page]
+
+# .rm file of every page of a document, older firmwares name the pages by
+# index, newer ones by the page UUIDs listed in the .content file
+def pagePaths(refNrPath, content, npages):
+    pages = content.get("pages") or [str(pg) for pg in range(0, npages)]
+    return [refNrPath + "/" + page + ".rm" for page in pages[:npages]]
+
+# Renders the annotations of every annotated page, sized as the page
+# they are drawn on. The pages of large documents are rendered in parallel
+# when an executor is given.
+# returns a dictionary page index -> rendered page
+def renderOverlays(refNrPath, content, basePages, executor=None, log=print):
+    jobs = []
+    for pg, rmpath in enumerate(pagePaths(refNrPath, content, len(basePages))):
+        if os.path.exists(rmpath): # Handle annotated pdf not on every single page
+            pdfsize = basePages[pg].mediaBox
+            pdfx = float(pdfsize.getWidth())
+            pdfy = float(pdfsize.getHeight())
+            jobs.append((pg, rmpath, pdfx, pdfy))
+    if not jobs:
+        return {}
+    pages, rmpaths, widths, heights = zip(*jobs)
+    caches = [cacheDirectory(remOverlayCache)] * len(jobs)
+    if executor is not None and len(jobs) >= largeDocumentPages:
+        # the workers do not report their stages, the parsing is counted
+        # in the rendering
+        with metrics.stage("convert.render"):
+            rendered = list(executor.map(renderPageFile, rmpaths, widths, heights, caches, chunksize=16))
+    else:
+        rendered = map(renderPageFile, rmpaths, widths, heights, caches)
+    # the pages that cannot be parsed are exported without their annotations
+    overlays = {}
+    for pg, overlay in zip(pages, rendered):
+        if isinstance(overlay, FormatError):
+            log("skipping annotations: " + str(overlay))
+        else:
+            overlays[pg] = overlay
+    return overlays
+
+# returns the rendered page, cached in the folder cache, or the FormatError
+# when the .rm file cannot be parsed
+def renderPageFile(rmpath, pdfx, pdfy, cache):
+    try:
+        return overlayCache(cache).get(rmpath, pdfx, pdfy)
+    except FormatError as error:
+        return error
+
+### CONVERT TO PDF ###
+# Exports all documents, or only the given UUIDs
+def convertFiles(jobs=1, documents=None):
+    with metrics.stage("convert"):
+        exportFiles(jobs, documents)
+        overlayCache(cacheDirectory(remOverlayCache)).prune(overlayCacheBytes)
+
+# Documents changed since they were last exported, of all documents or only
+# of the given UUIDs
+# returns a list of (UUID, metadata, library path, exported before, version)
+def changedDocuments(index, state, documents=None):
+    files = []
+    if documents is None:
+        forgetRemoved(index, state)
+        documents = index.documents()
+    moved = movedDocuments(index, state)
+    for x in documents:
+        document = documentChanged(index, state, x, moved)
+        if document is not None:
+            files.append(document)
+    unchanged = len(documents) - len(files)
+    print(str(unchanged) + " documents unchanged, " + str(len(files)) + " to export")
+    metrics.count("unchanged", unchanged)
+    metrics.count("exported", len(files))
+    return files
+
+# Forgets the exports of the documents removed from the backup
+def forgetRemoved(index, state):
+    for x in state.documents():
+        if x not in index:
+            print("removed: " + state.exported(x)[0])
+            state.removeDocument(x)
+
+# returns (UUID, metadata, library path, exported before, version) when the
+# document changed since it was last exported, None otherwise. The documents
+# moved in the library are left to the upload, which moves them on the
+# device.
+def documentChanged(index, state, x, moved=()):
+    meta = index[x]
+    pathDirectoryFile = index.path(meta["parent"])
+    if x in moved:
+        print("moved: " + pathDirectoryFile + meta["visibleName"] + " -> "
+              + os.path.relpath(moved[x], libraryDirectory()))
+        return None
+    # has this document changed since we last exported it?
+    version = state.documentVersion(backupDirectory(remContent), x, index.files[x])
+    exported = state.exported(x)
+    if exported is not None and exported[:3] == (meta["visibleName"], pathDirectoryFile, version) \
+            and all(os.path.exists(output) for output in exported[3]):
+        return None
+    print(("changed: " if exported is not None else "new: ") + pathDirectoryFile + meta["visibleName"])
+    # documents that were exported before are compared by content only,
+    # the modification times are used for the others
+    return (x, meta, pathDirectoryFile, exported is not None, version)
+
+# Documents whose library file was moved or renamed in the library: an
+# exported copy of the document is missing, and a library file that is not
+# exported from any document has its content
+# returns a dictionary UUID -> new library path
+def movedDocuments(index, state):
+    exports = state.outputs()
+    missing = {}
+    for x, outputs in exports.items():
+        for output in outputs:
+            if x in index and not output.endswith((".annot.pdf", ".notes.pdf")) and not os.path.exists(output):
+                path = backupDirectory(remContent) + "/" + x + os.path.splitext(output)[1]
+                if os.path.exists(path):
+                    missing.setdefault(state.fileHash(path), x)
+    if not missing:
+        return {}
+    known = {os.path.normpath(output) for outputs in exports.values() for output in outputs}
+    # once moved on the device, a document is exported to its new path
+    current = {os.path.normpath(libraryDirectory() + "/" + index.path(index[x]["parent"]) + index[x]["visibleName"])
+               for x in index.documents()}
+    moved = {}
+    for directoryPath, files in scanLibrary():
+        for fName, fType in files:
+            path = os.path.normpath(os.path.join(libraryDirectory(), directoryPath, fName + "." + fType))
+            if path not in known and os.path.splitext(path)[0] not in current and state.fileHash(path) in missing:
+                moved[missing[state.fileHash(path)]] = path
+    return moved
+
+# returns True when the library file of type fType of a document is gone:
+# none of the copies it was exported to exists, or the file at its library
+# path for a document never exported
+def libraryFileMoved(index, state, UUID, fType):
+    exported = state.exported(UUID)
+    paths = [output for output in exported[3] if output.endswith("." + fType)
+             and not output.endswith((".annot.pdf", ".notes.pdf"))] if exported is not None else []
+    if not paths:
+        meta = index[UUID]
+        paths = [libraryDirectory() + "/" + index.path(meta["parent"]) + meta["visibleName"] + "." + fType]
+    return not any(os.path.exists(path) for path in paths)
+
+# Records the export of a document in the state and in the metrics
+def recordExport(state, document, outputs, seconds):
+    state.setExported(document[0], document[1]["visibleName"], document[2], document[4], outputs)
+    state.commit()
+    metrics.documents.append({"uuid": document[0], "name": document[2] + document[1]["visibleName"],
+                              "seconds": seconds})
+
+# Exports the changed documents, in parallel with jobs > 1
+def exportFiles(jobs, documents):
+    index = loadIndex()
+    state = loadState()
+    with metrics.stage("convert.check"):
+        files = changedDocuments(index, state, documents)
+        order = scheduler.sort(index, [document[0] for document in files], lambda x: pendingPages(state, x))
+        rank = {x: n for n, x in enumerate(order)}
+        files.sort(key=lambda document: rank[document[0]])
+
+    def convert(document, executor=None):
+        start = time.perf_counter()
+        outputs = convertDocument(*document[:4], executor=executor)
+        recordExport(state, document, outputs, time.perf_counter() - start)
+
+    def defer(documents):
+        # changedDocuments counted them as exported
+        metrics.count("exported", -len(documents))
+        deferExports([document[0] for document in documents])
+
+    if jobs <= 1:
+        for n, document in enumerate(files):
+            if not scheduler.allows():
+                defer(files[n:])
+                return
+            convert(document)
+        return
+
+    # Documents are converted by the pool, at most 2 per worker are queued so
+    # that finished results do not pile up. The output of each document is
+    # printed in order once it is done.
+    def done(document, future):
+        lines, outputs, stages, seconds = future.result()
+        print("\n".join(lines))
+        metrics.merge(stages)
+        recordExport(state, document, outputs, seconds)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for n, document in enumerate(files):
+            if not scheduler.allows():
+                defer(files[n:])
+                break
+            refNrPath = backupDirectory(remContent) + "/" + document[0]
+            if len(glob.glob(refNrPath + "/*.rm")) >= largeDocumentPages:
+                # Large documents are converted here, with their pages
+                # rendered by the pool
+                while pending:
+                    done(*pending.popleft())
+                convert(document, executor)
+                continue
+            pending.append((document, executor.submit(convertDocumentJob, activeProfile(), *document[:4])))
+            if len(pending) >= 2 * jobs:
+                done(*pending.popleft())
+        while pending:
+            done(*pending.popleft())
+
+# Leaves the export of the documents to the next run, once the budget is
+# spent. They are not recorded as exported, the next run finds them changed.
+def deferExports(UUIDs):
+    for x in UUIDs:
+        scheduler.defer(x)
+    if UUIDs:
+        print(str(len(UUIDs)) + " documents left for the next run")
+        metrics.count("deferred", len(UUIDs))
+
+# Pages of a document to render: the pages modified since its last export,
+# all of them when it was never exported, and the pages changed on the
+# device that are not pulled yet
+def pendingPages(state, UUID, changed=()):
+    pages = {os.path.basename(path) for path in glob.glob(backupDirectory(remContent) + "/" + UUID + "/*.rm")}
+    exported = state.exported(UUID)
+    outputs = [output for output in exported[3] if os.path.exists(output)] if exported is not None else []
+    if outputs:
+        since = min(os.path.getmtime(output) for output in outputs)
+        pages = {page for page in pages
+                 if os.path.getmtime(backupDirectory(remContent) + "/" + UUID + "/" + page) > since}
+    pages.update(os.path.basename(path) for path in changed if path.endswith(".rm"))
+    return len(pages)
+
+# Converts a document in a worker process
+# returns the lines it would have printed, the exported files, the stages
+# timed and the seconds the conversion took
+def convertDocumentJob(profile, fileName, meta, pathDirectoryFile, force):
+    lines = []
+    useProfile(profile)
+    metrics.reset()
+    outputs = convertDocument(fileName, meta, pathDirectoryFile, force, lines.append)
+    return lines, outputs, metrics.stages, metrics.summary()["seconds"]
+
+# Exports the annotations or notes of one document to the library folder
+# pathDirectoryFile. When force is set the files are exported even if they
+# look up to date.
+# returns the library files the document is exported to
+def convertDocument(fileName, meta, pathDirectoryFile, force=False, log=print, executor=None):
+    # get file reference number
+    refNrPath = backupDirectory(remContent) + "/" + fileName
+    # get content Data
+    content = json.loads(open(refNrPath + ".content").read())
+    fname = meta["visibleName"]
+    # Does this lines file have an associated pdf?
+    isPDF = content["fileType"] == "pdf"
+
+    try:
+        os.makedirs(libraryDirectory() + "/" + pathDirectoryFile) # will create the directory only if it does not exist
+    except FileExistsError:
+        pass
+    
+    # Get list of all rm files i.e. all pages
+    rmPaths = glob.glob(refNrPath+"/*.rm")
+    npages = len(rmPaths)
+    
+    syncFilePath = libraryDirectory() + "/" + pathDirectoryFile + fname + ".pdf"
+    outputs = []
+    if npages != 0 & (not meta["deleted"]):
+        outputs.append(syncFilePath[:-4] + (".annot.pdf" if isPDF else ".notes.pdf"))
+        if isPDF:
+            # deal with annotated pdfs
+            # have we exported this thing before?
+            log("exporting PDF: " + fname)
+            local_annotExist = True if glob.glob(syncFilePath[:-4] + ".annot.pdf", recursive=True) != [] else False
+            remoteChanged = True
+            if local_annotExist and not force:
+                local_annotPath = glob.glob(syncFilePath[:-4]+".annot.pdf", recursive=True)[0]
+                local_annot_mod_time = os.path.getmtime(local_annotPath)
+                remote_annot_mod_time = int(meta["lastModified"])/1000 # rm time is in ms
+                # has this version changed since we last exported it?
+                remoteChanged = remote_annot_mod_time > local_annot_mod_time
+            if remoteChanged:
+                # only then fo we export
+                origPDF = refNrPath + ".pdf"
+                with open(origPDF, "rb") as origFile:
+                    with metrics.stage("convert.merge"):
+                        input1 = PdfFileReader(origFile)
+                        npages = input1.getNumPages() #Override pages number to maintain correspondence to the original PDF
+                        basePages = [input1.getPage(pg) for pg in range(0, npages)]
+                    # stamp the annotations on the annotated pages only
+                    overlays = renderOverlays(refNrPath, content, basePages, executor, log)
+                    with metrics.stage("convert.stamp"):
+                        stamp_pdf(basePages, overlays, syncFilePath[:-4] + ".annot.pdf")
+                log("exporting done!")
             else:
-                # deal with notes
-                # needs imagemagick
-                print("exporting Notebook: " + fname)
-                inSyncFolder = True if glob.glob(syncFilePath[:-4] + ".notes.pdf", recursive=True) != [] else False
-                remoteChanged = True
-                if inSyncFolder:
-                    local_annot_mod_time = os.path.getmtime(syncFilePath[:-4] + ".notes.pdf")
-                    remote_annot_mod_time = int(meta['lastModified'])/1000 # rm time is in ms
-                    # has this version changed since we last exported it?
-                    remoteChanged = remote_annot_mod_time > local_annot_mod_time
-                if remoteChanged:
-                    try:
-                        os.mkdir('temp')
-                    except:
-                        pass
-                    with open(refNrPath+".pagedata") as file:
-                        backgrounds = [line.strip() for line in file]
-
-                    bg_pg = 0
-                    bglist = []
-                    for bg in backgrounds:
-                        convertSvg2PdfCmd = "".join(["rsvg-convert -f pdf -o ", "temp/bg_" + str(bg_pg) + ".pdf ", str(remarkablePCDirectory + remTemplates) + bg.replace(" ", "\ ") + ".svg"])
-                        os.system(convertSvg2PdfCmd)
-                        bglist.append("temp/bg_"+str(bg_pg)+".pdf ")
-                        bg_pg += 1
-                    merged_bg = "temp/merged_bg.pdf"
-                    os.system("convert " + (" ").join(bglist) + " " + merged_bg)
-                    input1 = PdfFileReader(open(merged_bg, 'rb'))
-                    pdfsize = input1.getPage(0).mediaBox
-                    pdfx = int(pdfsize[2])
-                    pdfy = int(pdfsize[3])
-
-                    npages = len(glob.glob(refNrPath+"/*.rm"))
-                    pdflist = []
-                    for pg in range(0, npages):
-                        rmpath = rmPaths[pg]
-                        rm2svg(rmpath, "temp/temprm"+str(pg)+".svg", coloured_annotations=False)
-                        convertSvg2PdfCmd = "".join(["rsvg-convert -f pdf -o ", "temp/temppdf" + str(pg), ".pdf ", "temp/temprm" + str(pg) + ".svg"])
-                        os.system(convertSvg2PdfCmd)
-                        pdflist.append("temp/temppdf"+str(pg)+".pdf")
-                   
-                    merged_rm = "temp/merged_rm.pdf"
-                    os.system("pdftk "+ (" ").join(pdflist)+" cat output "+merged_rm)
-                    stampCmd = "".join(["pdftk ", "\""+merged_bg+"\"", " multistamp ", merged_rm, " output " + "\""+syncFilePath[:-4] + ".notes.pdf"+"\""])
-                    os.system(stampCmd)
-                    # Delete temp directory
-                    shutil.rmtree("temp", ignore_errors=False, onerror=None)
-                else:
-                    print(fname + " has not changed")
-        if isPDF & (not meta["deleted"]):
-            #copy file
-            print("copying PDF: " + fname)
-            inSyncFolder = True if glob.glob(syncFilePath) != [] else False
+                log(fname + " has not changed")
+        else:
+            # deal with notes
+            log("exporting Notebook: " + fname)
+            inSyncFolder = True if glob.glob(syncFilePath[:-4] + ".notes.pdf", recursive=True) != [] else False
             remoteChanged = True
-            if inSyncFolder:
-                local_annot_mod_time = os.path.getmtime(syncFilePath)
+            if inSyncFolder and not force:
+                local_annot_mod_time = os.path.getmtime(syncFilePath[:-4] + ".notes.pdf")
                 remote_annot_mod_time = int(meta['lastModified'])/1000 # rm time is in ms
                 # has this version changed since we last exported it?
                 remoteChanged = remote_annot_mod_time > local_annot_mod_time
             if remoteChanged:
+                with open(refNrPath+".pagedata") as file:
+                    backgrounds = [line.strip() for line in file]
+
+                # every page of the same template shares its content
+                basePages = []
+                with metrics.stage("convert.merge"):
+                    for bg in backgrounds:
+                        templatePage = loadTemplate(bg)
+                        if templatePage is not None:
+                            basePages.append(copy_page(templatePage))
+                        else:
+                            basePages.append(PageObject.createBlankPage(width=templateWidth, height=templateHeight))
+
+                # stamp the notes on their backgrounds
+                overlays = renderOverlays(refNrPath, content, basePages, executor, log)
+                with metrics.stage("convert.stamp"):
+                    stamp_pdf(basePages, overlays, syncFilePath[:-4] + ".notes.pdf")
+            else:
+                log(fname + " has not changed")
+    if isPDF & (not meta["deleted"]):
+        outputs.append(syncFilePath)
+        #copy file
+        log("copying PDF: " + fname)
+        inSyncFolder = True if glob.glob(syncFilePath) != [] else False
+        remoteChanged = True
+        if inSyncFolder and not force:
+            local_annot_mod_time = os.path.getmtime(syncFilePath)
+            remote_annot_mod_time = int(meta['lastModified'])/1000 # rm time is in ms
+            # has this version changed since we last exported it?
+            remoteChanged = remote_annot_mod_time > local_annot_mod_time
+        if remoteChanged:
+            with metrics.stage("convert.copy"):
                 shutil.copy2(refNrPath+".pdf",syncFilePath)
-                print("copying done!")
+            log("copying done!")
+        else:
+            log(fname + " has not changed")
+    return outputs
+
+### PIPELINED SYNC ###
+# Download, export and upload with the stages overlapped: the files
+# describing the entries are pulled first, then the documents in batches,
+# each exported as soon as its batch is complete while the library is
+# hashed for the upload. The export queue is bounded, the pulls wait when
+# the export falls behind.
+def syncPipelined(jobs=1):
+    syncProfiles([activeProfile()], jobs)
+
+# Syncs the devices of the profiles at the same time, in one event loop:
+# their transfers run in parallel and the documents of all of them are
+# converted by a single pool of jobs worker processes
+def syncProfiles(profiles, jobs):
+    with metrics.stage("sync"):
+        asyncio.run(syncAll(profiles, jobs))
+        for cache in {profile.cacheFolder() + remOverlayCache for profile in profiles}:
+            overlayCache(cache).prune(overlayCacheBytes)
+
+async def syncAll(profiles, jobs):
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        await asyncio.gather(*(syncProfile(profile, jobs, executor) for profile in profiles))
+
+async def syncProfile(profile, jobs, executor):
+    # runs in its own task, the profile is only active in it
+    useProfile(profile)
+    try:
+        await pipeline(jobs, executor)
+        # the state is only used by this thread until it is done
+        if await asyncio.to_thread(loadOnRM):
+            await asyncio.to_thread(restartRM)
+    except Exception as error:
+        # a device that fails, unreachable or full, does not stop the others
+        print("Sync of " + profile.name + " failed: " + str(error))
+        metrics.count("failed")
+
+async def pipeline(jobs, executor):
+    print("Backing up the files of " + activeProfile().name)
+    state = loadState()
+    content = deviceTransport(remarkableDirectory)
+    templates = deviceTransport(remarkableDirectoryTemplates)
+    with metrics.stage("download.list"):
+        (contentPaths, contentListing), (templatePaths, templateListing) = await asyncio.gather(
+            listChanges(content, backupDirectory(remContent), remContent),
+            listChanges(templates, backupDirectory(remTemplates), remTemplates))
+    describing = documentBatches(contentPaths, contentListing, pullBatchBytes)[0]
+    print(str(len(contentPaths)) + " files to download")
+    metrics.count("downloaded", len(contentPaths))
+    # the templates and the entries are needed by every export
+    with metrics.stage("download.entries"):
+        await asyncio.gather(pullFiles(content, describing, backupDirectory(remContent)),
+                             pullFiles(templates, templatePaths, backupDirectory(remTemplates)))
+    recordPull(state, remTemplates, templateListing)
+    if describing:
+        resetIndex()
+    index = loadIndex()
+    forgetRemoved(index, state)
+    # the documents are pulled, and exported, by priority
+    moved = movedDocuments(index, state)
+    changed = collections.defaultdict(list)
+    for path in contentPaths:
+        changed[entryOf(path)].append(path)
+    order = scheduler.sort(index, sorted(changed), lambda x: pendingPages(state, x, changed[x]))
+    batches = documentBatches(contentPaths, contentListing, pullBatchBytes, order)[1]
+
+    queue = asyncio.Queue(maxsize=2 * jobs)
+    # set once a document is checked, and exported if it changed
+    exported = collections.defaultdict(asyncio.Event)
+    converted = asyncio.Event()
+    # changed documents left for the next run once the budget is spent
+    deferred = []
+
+    async def download():
+        await pullDocuments(queue, content, batches, sorted({entryOf(path) for path in describing}))
+        recordPull(state, remContent, contentListing)
+        for n in range(jobs):
+            await queue.put(None)
+
+    async def convert():
+        largeDocuments = asyncio.Lock()
+        await asyncio.gather(*(exportQueue(queue, executor, exported, deferred, moved, largeDocuments)
+                               for n in range(jobs)))
+        deferExports(deferred)
+        converted.set()
+        for event in exported.values():
+            event.set()
+
+    await asyncio.gather(download(), convert(), stageUploads(index, exported, converted))
+
+# The files changed on the device since the last transfer, listed in
+# parallel on both sides
+# returns the changed paths and the listing of the device
+async def listChanges(transport, directory, root):
+    remote, local = await asyncio.gather(asyncio.to_thread(transport.listing),
+                                         asyncio.to_thread(localListing, directory))
+    return changedPaths(remote, local, loadState().manifest(root)), remote
+
+async def pullFiles(transport, paths, directory):
+    if paths:
+        await asyncio.to_thread(transport.pull, paths, directory)
+
+# Pulls the batches of documents and queues every document for the export
+# once its batch is complete, then queues the documents that were not
+# pulled: first by priority the ones whose entry changed or whose exports
+# are missing, then the others, which are checked in case an export was left
+# for later
+async def pullDocuments(queue, transport, batches, changedEntries):
+    index = loadIndex()
+    state = loadState()
+    streams = asyncio.Semaphore(pullStreams)
+
+    async def pullBatch(UUIDs, paths):
+        # the stream is held until the documents are queued
+        async with streams:
+            with metrics.stage("download.documents"):
+                await pullFiles(transport, paths, backupDirectory(remContent))
+            for UUID in UUIDs:
+                index.refresh(UUID)
+                await queue.put(UUID)
+
+    await asyncio.gather(*(pullBatch(*batch) for batch in batches))
+    pulled = {UUID for UUIDs, paths in batches for UUID in UUIDs}
+    exports = state.outputs()
+    missing = [UUID for UUID in index.documents() if UUID not in pulled
+               and not all(os.path.exists(output) for output in exports.get(UUID, [""]))]
+    urgent = scheduler.sort(index, changedEntries + missing, lambda x: pendingPages(state, x))
+    for UUID in urgent + index.documents():
+        if UUID not in pulled:
+            pulled.add(UUID)
+            await queue.put(UUID)
+
+# Exports the queued documents until None is queued, in the pool. Large
+# documents are converted in a thread, one at a time, with their pages
+# rendered by the pool. Once the budget is spent the changed documents are
+# added to deferred instead. The documents of moved are not exported.
+async def exportQueue(queue, executor, exported, deferred, moved, largeDocuments):
+    index = loadIndex()
+    state = loadState()
+    loop = asyncio.get_running_loop()
+    while True:
+        UUID = await queue.get()
+        if UUID is None:
+            return
+        document = None
+        if UUID in index and index.hasFile(UUID, ""):
+            document = documentChanged(index, state, UUID, moved)
+        if document is None:
+            metrics.count("unchanged")
+        elif not scheduler.allows():
+            # deferred before the upload planning sees it checked
+            scheduler.defer(UUID)
+            deferred.append(UUID)
+        else:
+            metrics.count("exported")
+            refNrPath = backupDirectory(remContent) + "/" + UUID
+            if len(glob.glob(refNrPath + "/*.rm")) >= largeDocumentPages:
+                async with largeDocuments:
+                    start = time.perf_counter()
+                    outputs = await asyncio.to_thread(convertDocument, *document[:4], executor=executor)
+                    seconds = time.perf_counter() - start
             else:
-                print(fname + " has not changed")
+                lines, outputs, stages, seconds = await loop.run_in_executor(executor, convertDocumentJob,
+                                                                               activeProfile(), *document[:4])
+                print("\n".join(lines))
+                metrics.merge(stages)
+            recordExport(state, document, outputs, seconds)
+        exported[UUID].set()
+
+# Plans the upload of the library during the export. The library files are
+# hashed first. A file of a document already on the device is planned once
+# the document is checked, the export may update it. The new files are
+# planned after the whole export, the exported library paths tell moved
+# files apart. The plan is then applied.
+async def stageUploads(index, exported, converted):
+    state = loadState()
+    library = [(directoryPath, fName, fType) for directoryPath, files in scanLibrary() for fName, fType in files]
+    with metrics.stage("upload.hash"):
+        for directoryPath, fName, fType in library:
+            state.fileHash(libraryDirectory() + "/" + directoryPath + "/" + fName + "." + fType)
+            await asyncio.sleep(0)
+        state.commit()
+
+    hashes = {}
+    folders = {}
+    plan = UploadPlan(backupDirectory(remContent))
+    new = []
+    for directoryPath, fName, fType in library:
+        parentUUID = libraryFolder(index, plan, directoryPath, folders)
+        UUID = index.findDocument(parentUUID, fName, "." + fType)
+        if not UUID:
+            new.append((directoryPath, fName, fType))
+            continue
+        if not converted.is_set():
+            await exported[UUID].wait()
+        with metrics.stage("upload.plan"):
+            cp(index, hashes, plan, directoryPath, fName, parentUUID, fType)
+
+    await converted.wait()
+    with metrics.stage("upload.plan"):
+        hashes.update(deviceHashes(index))
+        for directoryPath, fName, fType in new:
+            cp(index, hashes, plan, directoryPath, fName, libraryFolder(index, plan, directoryPath, folders), fType)
+        state.commit()
+    metrics.count("planned", len(plan))
+    with metrics.stage("upload.apply"):
+        await asyncio.to_thread(plan.apply)
+
+### WATCH ###
+# Keeps the library and the backup in sync as files change: new or modified
+# library files are staged in the backup, changed documents in the backup are
+# exported to the library
+def watchLibrary(jobs=1, quiet=2.0):
+    index = loadIndex()
+    watcher = makeWatcher([libraryDirectory(), backupDirectory(remContent)])
+    print("Watching " + libraryDirectory() + " and " + backupDirectory(remContent))
+    try:
+        while True:
+            changed = waitForChanges(watcher, quiet)
+            if overflowed in changed:
+                # events were lost: the whole backup is checked for changed
+                # documents and the whole library for uploads
+                print("Too many changes, checking everything")
+                resetIndex()
+                index = loadIndex()
+                convertFiles(jobs)
+                prepareUpload(False)
+                continue
+            documents = set()
+            uploads = set()
+            for path in changed:
+                if isInside(path, backupDirectory(remContent)):
+                    # xochitl/UUID.ext or xochitl/UUID/page.rm
+                    relativePath = os.path.relpath(path, backupDirectory(remContent))
+                    UUID = os.path.splitext(relativePath.split(os.sep)[0])[0]
+                    if UUID != ".":
+                        documents.add(UUID)
+                elif isInside(path, libraryDirectory()) and os.path.isfile(path):
+                    fName, fType = os.path.splitext(path)
+                    if fType[1:] in uploadTypes and not fName.endswith((".annot", ".notes")):
+                        uploads.add(path)
+            for UUID in sorted(documents):
+                try:
+                    index.refresh(UUID)
+                except ValueError:
+                    print("skipping " + UUID + ": metadata is being written")
+            if uploads:
+                hashes = deviceHashes(index)
+                folders = {}
+                plan = UploadPlan(backupDirectory(remContent))
+                for path in sorted(uploads):
+                    uploadFile(index, hashes, plan, path, folders)
+                loadState().commit()
+                with metrics.stage("upload.apply"):
+                    plan.apply()
+            documents = [UUID for UUID in sorted(documents) if UUID in index and index.hasFile(UUID, "")]
+            if documents:
+                convertFiles(jobs, documents)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def isInside(path, directory):
+    return os.path.abspath(path).startswith(os.path.abspath(directory) + os.sep)
+
+### SNAPSHOTS ###
+# Folders of the backup kept in the snapshots
+snapshotRoots = (remContent.strip("/"), remTemplates.strip("/"))
+
+def snapshotStore():
+    return SnapshotStore(backupDirectory(remSnapshots))
+
+# Snapshots the backup as it is now. The hashes of the files are the ones of
+# the sync state, only the files changed since the last sync are read.
+def takeSnapshot():
+    state = loadState()
+    listing = {}
+    for root in snapshotRoots:
+        listing.update((root + "/" + path, entry) for path, entry in localListing(backupDirectory("/" + root)).items())
+    with metrics.stage("snapshot"):
+        name = snapshotStore().take(backupDirectory(), listing, state.fileHash)
+    state.commit()
+    print("snapshot " + name + ": " + str(len(listing)) + " files")
+
+def listSnapshots():
+    store = snapshotStore()
+    for name in store.names():
+        files = store.load(name)
+        print(name + ": " + str(len(files)) + " files, " + str(sum(entry[1] for entry in files.values()) >> 20) + " MB")
+
+# Prints the documents added, removed or changed from the snapshot old to
+# the snapshot new, by name, and the templates that differ
+def diffSnapshots(old, new):
+    store = snapshotStore()
+    oldFiles, newFiles = store.load(old), store.load(new)
+    documents = {}
+    for path, (before, after) in sorted(store.diff(old, new).items()):
+        root, relativePath = path.split("/", 1)
+        if root == snapshotRoots[0]:
+            documents.setdefault(entryOf(relativePath), []).append(relativePath)
+        else:
+            print(("added" if before is None else "removed" if after is None else "changed") + " template: "
+                  + relativePath)
+    for UUID, paths in sorted(documents.items()):
+        metadata = snapshotRoots[0] + "/" + UUID + ".metadata"
+        status = "added" if metadata not in oldFiles else "removed" if metadata not in newFiles else "changed"
+        entry = newFiles.get(metadata) or oldFiles.get(metadata)
+        name = json.loads(store.read(entry))["visibleName"] if entry is not None else UUID
+        print(status + ": " + name + " (" + str(len(paths)) + " files)")
+
+def restoreSnapshot(name, directory):
+    with metrics.stage("snapshot.restore"):
+        n = snapshotStore().restore(name, directory, snapshotRoots)
+    print(str(n) + " files restored to " + directory)
+
+def pruneSnapshots(keep):
+    removed, blobs = snapshotStore().prune(keep)
+    print(str(len(removed)) + " snapshots removed, " + str(blobs) + " files no longer referenced")
 
 ### UPLOAD ###
-def prepareUploadPDF(dry):
-    # list of files in Library
-    syncFilesList = glob.glob(syncDirectory + "/**/*.pdf", recursive=True)
-    # remove noted files and notes
-    syncFilesList = [x for x in syncFilesList if ".annot" not in x ]
-    syncFilesList = [x for x in syncFilesList if ".notes" not in x ]
-
-    # list of files on the rM (hashed)
-    rmPdfList = glob.glob(remarkablePCDirectory + remContent + "/*.pdf")
-    rmPdfList = [x[:-4] for x in rmPdfList]
-
-    # list of all elements in the remarkable
-    rmElements = glob.glob(remarkablePCDirectory + remContent + "/*.content")
-    rmElements = [x[:-8] for x in rmElements]
-
-    # list of all folders in the remarkable
-    rmDirectories =  [x for x in rmElements if x not in rmPdfList]
-
-    for pathFile in syncFilesList:
-        pathFile = pathFile[:-4]
-
-        relativePath = os.path.relpath(pathFile, syncDirectory)
-        fName = os.path.basename(pathFile)
-        directoryPath = os.path.dirname(relativePath)
-
-        directoriesName = re.split("/|\\)", directoryPath)
-     
-        parentUUID = ""
-        for directory in directoriesName:
-            parentUUID = mkdir(rmDirectories, parentUUID, directory, dry)
-            rmDirectories.append(remarkablePCDirectory + remContent + '/' + parentUUID)
-
-        cp(rmPdfList, directoryPath, fName, parentUUID, "pdf", dry)
-
-def prepareUploadEBUP(dry):
-    # list of files in Library
-    syncFilesList = glob.glob(syncDirectory + "/**/*.epub", recursive=True)
-    # remove noted files and notes
-    syncFilesList = [x for x in syncFilesList if ".annot" not in x ]
-    syncFilesList = [x for x in syncFilesList if ".notes" not in x ]
-
-    # list of files on the rM (hashed)
-    rmPdfList = glob.glob(remarkablePCDirectory + remContent + "/*.epub")
-    rmPdfList = [x[:-5] for x in rmPdfList]
-    
-    # list of all elements in the remarkable
-    rmElements = glob.glob(remarkablePCDirectory + remContent + "/*.content")
-    rmElements = [x[:-8] for x in rmElements]
+# Lists the library in a single pass
+# returns a list of (relative directory, [(name, type)]) of the files that
+# can be uploaded, without the exported .annot and .notes files
+def scanLibrary():
+    library = []
+    directories = [""]
+    while directories:
+        directoryPath = directories.pop()
+        files = []
+        with os.scandir(os.path.join(libraryDirectory(), directoryPath)) as it:
+            for entry in it:
+                if entry.is_dir():
+                    directories.append(directoryPath + "/" + entry.name if directoryPath else entry.name)
+                    continue
+                fName, fType = os.path.splitext(entry.name)
+                fType = fType[1:]
+                if fType in uploadTypes and not fName.endswith((".annot", ".notes")):
+                    files.append((fName, fType))
+        if files:
+            library.append((directoryPath, sorted(files)))
+    return sorted(library)
 
-    # list of all folders in the remarkable
-    rmDirectories =  [x for x in rmElements if x not in rmPdfList]
+# Plans the upload of the library, and applies the plan unless dry is set.
+# The plan is also saved as JSON to planFile when given.
+# returns the plan
+def prepareUpload(dry, planFile=None):
+    index = loadIndex()
+    folders = {}
+    plan = UploadPlan(backupDirectory(remContent))
 
-    for pathFile in syncFilesList:
-        pathFile = pathFile[:-5]
+    with metrics.stage("upload.plan"):
+        hashes = deviceHashes(index)
+        for directoryPath, files in scanLibrary():
+            parentUUID = libraryFolder(index, plan, directoryPath, folders)
+            for fName, fType in files:
+                cp(index, hashes, plan, directoryPath, fName, parentUUID, fType)
+        loadState().commit()
+    metrics.count("planned", len(plan))
 
-        relativePath = os.path.relpath(pathFile, syncDirectory)
-        fName = os.path.basename(pathFile)
-        directoryPath = os.path.dirname(relativePath)
+    if planFile:
+        plan.dump(planFile)
+    if dry:
+        # the index holds the planned entries, which were not written
+        resetIndex()
+    else:
+        with metrics.stage("upload.apply"):
+            plan.apply()
+    return plan
 
-        directoriesName = re.split("/|\\)", directoryPath)
-     
-        parentUUID = ""
-        for directory in directoriesName:
-            parentUUID = mkdir(rmDirectories, parentUUID, directory, dry)
-        cp(rmPdfList, directoryPath, fName, parentUUID, "epub", dry)
+# Copies a library file to the backup, in the same folders
+# returns UUID
+def uploadFile(index, hashes, plan, pathFile, folders):
+    pathFile, fType = os.path.splitext(pathFile)
+    relativePath = os.path.relpath(pathFile, libraryDirectory()).replace(os.sep, "/")
+    directoryPath, fName = os.path.split(relativePath)
+    parentUUID = libraryFolder(index, plan, directoryPath, folders)
+    return cp(index, hashes, plan, directoryPath, fName, parentUUID, fType[1:])
+
+# UUID of the folder of the library at directoryPath, the folders are
+# created if they don't exist. folders memoizes the UUIDs of the folders.
+def libraryFolder(index, plan, directoryPath, folders):
+    if directoryPath == "":
+        return ""
+    if directoryPath not in folders:
+        parentPath, name = os.path.split(directoryPath)
+        folders[directoryPath] = mkdir(index, plan, libraryFolder(index, plan, parentPath, folders), name)
+    return folders[directoryPath]
 
-# Creates folder if it doesn't exist
+# Plans the folder if it doesn't exist
 # returns UUID
-def mkdir(rmDirectories, parentUUID, name, dry):
-    candiates = []
-    for d in rmDirectories:
-        meta = json.loads(open(d + ".metadata").read())
-        if meta["parent"] == parentUUID:
-            candiates.append(d)
-
-    UUID = ""
-
-    for c in candiates:
-        meta = json.loads(open(c + ".metadata").read())
-        if  meta["visibleName"] == name:
-            UUID = os.path.basename(c)
-     
+def mkdir(index, plan, parentUUID, name):
+    UUID = index.findFolder(parentUUID, name)
     if UUID: #Folder exists
         return UUID
     # Create the new folder
-    return writeDir(parentUUID, name, dry)
+    return writeDir(index, plan, parentUUID, name)
 
-# Creates folder
+# Plans a new folder
 # returns UUID
-def writeDir(parentUUID, name, dry):
+def writeDir(index, plan, parentUUID, name):
 
     UUID = str(uuid.uuid4())
     
@@ -347,56 +1139,78 @@ def writeDir(parentUUID, name, dry):
     }
 
     content = {}
-    basePath = remarkablePCDirectory + remContent + "/" + UUID
+    basePath = backupDirectory(remContent) + "/" + UUID
 
     print("write dir: " + name + " \t" +  basePath)
-    if not dry:
-        with open(basePath + ".content", 'w') as outfile:  
-            json.dump(content, outfile)
-        with open(basePath + ".metadata", 'w') as outfile:  
-            json.dump(metadata, outfile)
+    plan.addFolder(UUID, metadata, content)
+    # the planned folder is recorded, so that its content goes in it
+    index.update(UUID, metadata, (".content",))
     return UUID
 
 
-# Creates folder if it doesn't exist
+# Hash of the file of every document in the backup
+# returns a dictionary hash -> list of UUIDs
+def deviceHashes(index):
+    state = loadState()
+    hashes = {}
+    for fType in uploadTypes:
+        for UUID in index.withFile("." + fType):
+            path = backupDirectory(remContent) + "/" + UUID + "." + fType
+            hashes.setdefault(state.fileHash(path), []).append(UUID)
+    state.commit()
+    return hashes
+
+# Copies the file to the backup if it is new or its content has changed,
+# files moved or renamed in the library only get their metadata updated
 # returns UUID
-def cp(rmPdfList, directoryPath, fName, parentUUID, fType, dry):
-    
-    candiates = []
-    for d in rmPdfList:
-        meta = json.loads(open(d + ".metadata").read())
-        if meta["parent"] == parentUUID:
-            candiates.append(d)
-
-    UUID = ""
-    fileExist = False
-    
-    for c in candiates:
-        meta = json.loads(open(c + ".metadata").read())
-        if  meta["visibleName"] == fName:
-            UUID = os.path.basename(c)
-            fileExist = True
-    
-    localChanged = True
+def cp(index, hashes, plan, directoryPath, fName, parentUUID, fType):
+    state = loadState()
+    localPath = libraryDirectory() + "/" + directoryPath + "/" + fName + "." + fType
+    localHash = state.fileHash(localPath)
 
-    basePath = remarkablePCDirectory + remContent + "/" + UUID
+    UUID = index.findDocument(parentUUID, fName, "." + fType)
+    fileExist = UUID != ""
+
+    basePath = backupDirectory(remContent) + "/" + UUID
+
+    local_annot_mod_time = int(os.path.getmtime(localPath))
+
+    if not fileExist:
+        # a document with the same content whose library file is gone has
+        # been moved or renamed
+        for candidate in hashes.get(localHash, []):
+            meta = index[candidate]
+            if not meta.get("deleted") and index.hasFile(candidate, "." + fType) \
+                    and libraryFileMoved(index, state, candidate, fType):
+                UUID = candidate
+                break
+        if UUID:
+            meta = dict(index[UUID])
+            print("move file: " + index.path(meta["parent"]) + meta["visibleName"] + " -> " + directoryPath + "/" + fName)
+            meta["parent"] = parentUUID
+            meta["visibleName"] = fName
+            meta["lastModified"] = int(time.time()*1000.0)
+            plan.addUpdate(UUID, meta)
+            index.update(UUID, meta)
+            return UUID
+
+    if fileExist and UUID in scheduler.deferred:
+        # the export of the document was left for the next run, the library
+        # file may be older than the one of the device
+        return UUID
 
-    local_annot_mod_time = int(os.path.getmtime(syncDirectory + "/" + directoryPath + "/" + fName + "." + fType))
-    
     if fileExist:
-        meta = json.loads(open(basePath + ".metadata").read())
-        remote_annot_mod_time = int(int(meta['lastModified'])/1000) # rm time is in ms
-        # has this version changed since we last exported it?
-        localChanged = remote_annot_mod_time < local_annot_mod_time
+        # has the content changed since we last copied it?
+        localChanged = state.fileHash(basePath + "." + fType) != localHash
         if localChanged:
+            meta = dict(index[UUID])
             meta['lastModified'] = local_annot_mod_time*1000
-            if not dry:
-                with open(basePath + ".metadata", 'w') as outfile:  
-                    json.dump(meta, outfile)
+            plan.addUpdate(UUID, meta, localPath, fType)
+            index.update(UUID, meta)
             print("update file: " + fName)
     else:
         UUID = str(uuid.uuid4())
-        basePath = remarkablePCDirectory + remContent + "/" + UUID
+        basePath = backupDirectory(remContent) + "/" + UUID
   
         content = {"extraMetadata":{},"fileType": fType,"lastOpenedPage":0,"lineHeight":-1,"margins":180,"textScale":1,"transform":{}}
         metadata = {
@@ -411,24 +1225,11 @@ def cp(rmPdfList, directoryPath, fName, parentUUID, fType, dry):
             "version": 1,
             "visibleName": fName
         }
-        if not dry:
-            os.mkdir(basePath)  
-            os.mkdir(basePath + ".thumbnails")
-            os.mkdir(basePath + ".textconversion")  
-            os.mkdir(basePath + ".highlights")  
-            os.mkdir(basePath + ".cache")  
-            with open(basePath + ".content", 'w') as outfile:  
-                json.dump(content, outfile)
-            with open(basePath + ".metadata", 'w') as outfile:  
-                json.dump(metadata, outfile)
-            open(basePath + ".pagedata", 'w')
+        plan.addDocument(UUID, localPath, fType, metadata, content)
+        index.update(UUID, metadata, ("", ".content", ".pagedata", "." + fType))
+        hashes.setdefault(localHash, []).append(UUID)
         print("write file: " + fName + " \t" +  basePath)
     
-    if localChanged: #perform copy
-     
-        if not dry:
-         shutil.copy(syncDirectory + "/" + directoryPath + "/" + fName + "." + fType, basePath + "." + fType)
-    
     return UUID
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# Persistent state of the sync, stored as a SQLite database in the backup
+# directory.
+#
+# files:     stat signature (size, mtime) of every file seen, with the hash of
+#            its content. A file is only read again when its signature
+#            changed. Databases of older versions have a data column, which
+#            is no longer used.
+# documents: for every document the version (hash of all its files), the
+#            name, library path and the outputs of the last export.
+# manifest:  size and mtime of the files of the device as they were last
+#            transferred, for every transferred directory (root).
+#
+import os
+import sqlite3
+import hashlib
+
+# Hashes computed by all the SyncStates of the process, by path and stat
+# signature: the profiles of a multi-device sync sharing a library hash its
+# files once
+sharedHashes = {}
+
+
+class SyncState:
+    def __init__(self, path):
+        self.path = path
+        # a state is used by one thread at a time, not always the one that
+        # opened it
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                hash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                uuid TEXT PRIMARY KEY,
+                name TEXT,
+                library_path TEXT,
+                version TEXT,
+                outputs TEXT
+            );
+            CREATE TABLE IF NOT EXISTS manifest (
+                root TEXT,
+                path TEXT,
+                size INTEGER,
+                mtime REAL,
+                PRIMARY KEY (root, path)
+            );
+        ''')
+        self.files = {row[0]: list(row[1:]) for row in self.db.execute('SELECT path, size, mtime, hash FROM files')}
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def _entry(self, path, st):
+        # Cached row of path, reset when the file changed
+        if st is None:
+            st = os.stat(path)
+        entry = self.files.get(path)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+            entry = [st.st_size, st.st_mtime_ns, None]
+            self.files[path] = entry
+            self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                            (path, st.st_size, st.st_mtime_ns))
+        return entry
+
+    def fileHash(self, path, st=None):
+        # SHA-1 of the content of path, only computed when the file changed
+        entry = self._entry(path, st)
+        if entry[2] is None:
+            key = (os.path.abspath(path), entry[0], entry[1])
+            if key not in sharedHashes:
+                digest = hashlib.sha1()
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(block)
+                sharedHashes[key] = digest.hexdigest()
+            entry[2] = sharedHashes[key]
+            self.db.execute('UPDATE files SET hash = ? WHERE path = ?', (entry[2], path))
+        return entry[2]
+
+    def documentVersion(self, directory, UUID, extensions):
+        # Hash of all the files of a document: its top level files and the
+        # files in its page directory. The .metadata file is left out, the
+        # name and folder of the document are compared separately and its
+        # other fields do not change the exported files.
+        digest = hashlib.sha1()
+        names = [UUID + ext for ext in sorted(extensions) if ext and ext != '.metadata']
+        if '' in extensions:
+            with os.scandir(os.path.join(directory, UUID)) as it:
+                pages = sorted((entry.name, entry) for entry in it if entry.is_file())
+            for name, entry in pages:
+                digest.update((UUID + '/' + name).encode())
+                digest.update(self.fileHash(entry.path, entry.stat()).encode())
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            digest.update(name.encode())
+            digest.update(self.fileHash(path, st).encode())
+        return digest.hexdigest()
+
+    def exported(self, UUID):
+        # (name, library path, version, outputs) of the last export of a
+        # document, None if it has never been exported
+        row = self.db.execute('SELECT name, library_path, version, outputs FROM documents WHERE uuid = ?',
+                              (UUID,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3].split('\n') if row[3] else []
+
+    def setExported(self, UUID, name, libraryPath, version, outputs):
+        self.db.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)',
+                        (UUID, name, libraryPath, version, '\n'.join(outputs)))
+
+    def documents(self):
+        return [row[0] for row in self.db.execute('SELECT uuid FROM documents')]
+
+    def outputs(self):
+        # {UUID: outputs of its last export} of all exported documents
+        return {row[0]: row[1].split('\n') if row[1] else [] for row in
+                self.db.execute('SELECT uuid, outputs FROM documents')}
+
+    def removeDocument(self, UUID):
+        self.db.execute('DELETE FROM documents WHERE uuid = ?', (UUID,))
+
+    def manifest(self, root):
+        return {row[0]: (row[1], row[2]) for row in
+                self.db.execute('SELECT path, size, mtime FROM manifest WHERE root = ?', (root,))}
+
+    def setManifest(self, root, files):
+        self.db.executemany('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)',
+                            ((root, path, size, mtime) for path, (size, mtime) in files))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+#
+# Tests of the decoding of the .rm files (rM2svg.py): the versions of the
+# format, the files that can not be parsed and the output of the decoder.
+#
+import random
+import struct
+import hashlib
+
+import numpy as np
+import pytest
+
+import rmgen
+import rM2svg
+
+
+def test_segments_decoded_as_by_struct():
+    data = rmgen.linesFile(strokes=5, segments=7, rng=random.Random(1))
+    page = rM2svg.parse_page(data)
+    offset = rM2svg.header_size + 8
+    for stroke in page.strokes():
+        offset += rM2svg.stroke_formats[3].size
+        expected = [struct.unpack_from("<ffffff", data, offset + 24 * n) for n in range(7)]
+        assert stroke.segments.dtype == np.float32
+        assert stroke.segments.astype(np.float64).tolist() == [list(segment) for segment in expected]
+        offset += 24 * 7
+
+
+# SHA-1 of the SVG written by the per-segment decoder that came before the
+# NumPy one, for the same pages: (seed, width, height, coloured annotations)
+reference_outputs = {
+    (1, 1404, 1872, False): "b731b3734e5e9c30fe61eae19af5102337956ab4",
+    (2, 595, 842, False): "57fd5f0b9150864e950344b7be73558fe5a6d3aa",
+    (3, 842, 595, True): "f027f5db7ac10a148bd362d009279126adc9e744",
+}
+
+
+@pytest.mark.parametrize("seed, width, height, coloured", sorted(reference_outputs))
+def test_output_byte_identical(tmp_path, seed, width, height, coloured):
+    rmgen.writeLines(str(tmp_path / "page.rm"), layers=2, strokes=20, segments=15, rng=random.Random(seed))
+    rM2svg.rm2svg(str(tmp_path / "page.rm"), str(tmp_path / "page.svg"), coloured, width, height)
+    with open(tmp_path / "page.svg", "rb") as f:
+        assert hashlib.sha1(f.read()).hexdigest() == reference_outputs[(seed, width, height, coloured)]
+
+
+def test_coloured_palette_not_kept(tmp_path):
+    rmgen.writeLines(str(tmp_path / "page.rm"), strokes=20, segments=5, rng=random.Random(4))
+    rM2svg.rm2svg(str(tmp_path / "page.rm"), str(tmp_path / "before.svg"))
+    rM2svg.rm2svg(str(tmp_path / "page.rm"), str(tmp_path / "coloured.svg"), coloured_annotations=True)
+    rM2svg.rm2svg(str(tmp_path / "page.rm"), str(tmp_path / "after.svg"))
+    assert (tmp_path / "before.svg").read_bytes() == (tmp_path / "after.svg").read_bytes()
+    assert (tmp_path / "before.svg").read_bytes() != (tmp_path / "coloured.svg").read_bytes()
+
+
+def test_v3_and_v5_decoded_alike():
+    pages = [rM2svg.parse_page(rmgen.linesFile(layers=2, strokes=4, segments=3, rng=random.Random(5), version=version))
+             for version in (3, 5)]
+    assert [page.version for page in pages] == [3, 5]
+    v3, v5 = ([(stroke.pen, stroke.colour, stroke.width, stroke.segments.tolist()) for stroke in page.strokes()]
+              for page in pages)
+    assert len(v3) == 8 and v3 == v5
+
+
+def test_segments_are_views_on_the_data():
+    data = rmgen.linesFile(strokes=2, segments=3, version=5)
+    view = memoryview(data)
+    for stroke in rM2svg.parse_page(view).strokes():
+        assert np.shares_memory(stroke.segments, np.frombuffer(data, dtype=np.uint8))
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"not a reMarkable file".ljust(rM2svg.header_size + 4, b" "),
+    rmgen.linesHeader(4) + struct.pack("<I", 1),
+    rmgen.linesHeader(3) + struct.pack("<I", 0),
+])
+def test_format_error_on_other_files(data):
+    with pytest.raises(rM2svg.FormatError):
+        rM2svg.parse_page(data)
+
+
+@pytest.mark.parametrize("version", [3, 5])
+def test_format_error_on_truncated_files(version):
+    data = rmgen.linesFile(strokes=3, segments=4, version=version)
+    for end in (rM2svg.header_size + 2, rM2svg.header_size + 10, len(data) - 1):
+        with pytest.raises(rM2svg.FormatError):
+            rM2svg.parse_page(data[:end])
+
+
+def test_unparsable_page_left_blank(tmp_path, capsys):
+    path = str(tmp_path / "page.rm")
+    with open(path, "wb") as f:
+        f.write(rmgen.linesHeader(6) + struct.pack("<I", 1))
+    with pytest.raises(rM2svg.FormatError, match="page.rm"):
+        rM2svg.load_page(path)
+    assert rM2svg.load_page_or_blank(path).layers == []
+    assert rM2svg.convert_or_skip(rM2svg.rm2svg, path, str(tmp_path / "page.svg")) is None
+    assert "Skipping page" in capsys.readouterr().err
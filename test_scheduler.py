@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Tests of the order of the exports and of the time budget (scheduler.py).
+#
+import time
+
+import pytest
+
+import sync
+import rmgen
+from profiles import Profile
+from scheduler import Scheduler
+
+
+class Index:
+    # The part of MetadataIndex used by the scheduler
+    def __init__(self, entries):
+        self.entries = entries  # UUID -> metadata
+
+    def __contains__(self, UUID):
+        return UUID in self.entries
+
+    def __getitem__(self, UUID):
+        return self.entries[UUID]
+
+    def path(self, parent):
+        return "" if parent == "" else self.entries[parent]["visibleName"] + "/"
+
+
+def document(name, lastModified, parent="", pinned=False):
+    return {"visibleName": name, "lastModified": str(lastModified), "parent": parent, "pinned": pinned}
+
+
+index = Index({
+    "folder": document("Folder", 0),
+    "a": document("Old", 1000),
+    "b": document("New", 3000),
+    "c": document("Middle", 2000, parent="folder"),
+    "d": document("Pinned", 500, pinned=True),
+})
+pages = {"a": 5, "b": 9, "c": 1, "d": 20}
+
+
+def test_recent_first_after_pinned():
+    order = Scheduler("recent").sort(index, ["a", "b", "c", "d"], pages.get)
+    assert order == ["d", "b", "c", "a"]
+
+
+def test_fewest_pages_first():
+    order = Scheduler("pages").sort(index, ["a", "b", "c", "d"], pages.get)
+    assert order == ["d", "c", "a", "b"]
+
+
+def test_listing_by_UUID():
+    assert Scheduler("listing", pinned=["b"]).sort(index, ["d", "c", "b", "a"], pages.get) == ["b", "d", "a", "c"]
+
+
+def test_pinned_by_name_path_or_UUID():
+    for pinned in ("Old", "a", "Folder/Middle"):
+        scheduler = Scheduler("recent", pinned=[pinned])
+        first = scheduler.sort(index, ["a", "b", "c"], pages.get)[0]
+        assert first == ("c" if pinned == "Folder/Middle" else "a")
+
+
+def test_pages_only_counted_by_the_pages_order():
+    def fail(UUID):
+        raise AssertionError("pendingPages called")
+    Scheduler("recent").sort(index, ["a", "b"], fail)
+    Scheduler("listing").sort(index, ["a", "b"], fail)
+
+
+def test_unknown_documents_last():
+    assert Scheduler("recent").sort(index, ["gone", "a", "b"], pages.get) == ["b", "a", "gone"]
+
+
+def test_unknown_order():
+    with pytest.raises(ValueError):
+        Scheduler("random")
+
+
+def test_no_budget_never_stops():
+    scheduler = Scheduler()
+    scheduler.start()
+    assert scheduler.allows()
+
+
+def test_budget_defers():
+    scheduler = Scheduler(budget=0.05)
+    assert scheduler.allows()
+    scheduler.start()
+    assert scheduler.allows()
+    time.sleep(0.06)
+    assert not scheduler.allows()
+    scheduler.defer("a")
+    assert scheduler.deferred == {"a"}
+
+
+def test_budget_leaves_exports_for_the_next_run(tmp_path, monkeypatch):
+    backup, library = str(tmp_path / "backup"), str(tmp_path / "library")
+    UUIDs = rmgen.makeTree(backup, 4, strokes=5, segments=5)
+    profile = Profile("test", library, backup, sync.remarkableIP, sync.remarkableUsername)
+    sync.useProfile(profile)
+    try:
+        # a spent budget exports nothing, and nothing is recorded
+        monkeypatch.setattr(sync, "scheduler", Scheduler(budget=0))
+        sync.scheduler.start()
+        sync.convertFiles()
+        assert sync.scheduler.deferred == set(UUIDs)
+        assert sync.loadState().documents() == []
+
+        # the next run exports them
+        monkeypatch.setattr(sync, "scheduler", Scheduler())
+        sync.convertFiles()
+        assert sorted(sync.loadState().documents()) == sorted(UUIDs)
+    finally:
+        profile.state.close()
+        sync.useProfile(None)
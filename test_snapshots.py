@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# Tests of the snapshots of the backup (snapshots.py): the blobs shared by
+# the snapshots, their reference counting when pruning, and the files a
+# restore removes.
+#
+import os
+import hashlib
+
+import pytest
+
+from snapshots import SnapshotStore
+from transfer import localListing
+
+
+def write(path, data, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def take(store, backup):
+    return store.take(backup, localListing(backup), fileHash)
+
+
+def fileHash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def blobs(store):
+    return {prefix + name for prefix in os.listdir(store.blobs)
+            for name in os.listdir(os.path.join(store.blobs, prefix))}
+
+
+@pytest.fixture
+def backup(tmp_path):
+    backup = str(tmp_path / "backup")
+    write(backup + "/xochitl/a.metadata", "a", 1000)
+    write(backup + "/xochitl/a/0.rm", "page", 1000)
+    write(backup + "/xochitl/b.metadata", "b", 1000)
+    write(backup + "/templates/t.svg", "page", 1000)
+    return backup
+
+
+def test_unchanged_files_are_stored_once(tmp_path, backup):
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    first = take(store, backup)
+    # the same content twice is one blob
+    assert len(blobs(store)) == 3
+    write(backup + "/xochitl/a/0.rm", "changed")
+    second = take(store, backup)
+    assert len(blobs(store)) == 4
+    assert store.names() == [first, second]
+    assert set(store.diff(first, second)) == {"xochitl/a/0.rm"}
+
+def test_blobs_are_copies(tmp_path, backup):
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    name = take(store, backup)
+    digest = fileHash(backup + "/xochitl/b.metadata")
+    assert os.stat(store.blobPath(digest)).st_nlink == 1
+    # a file written in place changes neither the blob nor its restored copy
+    target = str(tmp_path / "restored")
+    store.restore(name, target, ["xochitl", "templates"])
+    assert os.stat(target + "/xochitl/b.metadata").st_nlink == 1
+    with open(backup + "/xochitl/b.metadata", "w") as f:
+        f.write("written in place")
+    with open(target + "/xochitl/b.metadata", "w") as f:
+        f.write("edited")
+    assert fileHash(store.blobPath(digest)) == digest
+
+
+def test_prune_removes_the_blobs_no_longer_referenced(tmp_path, backup):
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    first = take(store, backup)
+    old = fileHash(backup + "/xochitl/a/0.rm")
+    write(backup + "/xochitl/a/0.rm", "changed")
+    os.remove(backup + "/xochitl/b.metadata")
+    second = take(store, backup)
+    write(backup + "/xochitl/a/0.rm", "changed again")
+    third = take(store, backup)
+
+    # the old page has the content of the template, its blob is still used
+    assert store.prune(2) == ([first], 1)
+    assert store.names() == [second, third]
+    assert fileHash(backup + "/templates/t.svg") == old and old in blobs(store)
+    assert fileHash(store.blobPath(old)) == old
+
+    assert store.prune(1) == ([second], 1)
+    assert blobs(store) == {entry[0] for entry in store.load(third).values()}
+    # nothing left to remove
+    assert store.prune(1) == ([], 0)
+
+
+def test_prune_keeps_the_newest(tmp_path, backup):
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    name = take(store, backup)
+    for keep in (0, -1):
+        with pytest.raises(ValueError):
+            store.prune(keep)
+    assert store.names() == [name]
+    assert len(blobs(store)) == 3
+
+
+def test_restore(tmp_path, backup):
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    first = take(store, backup)
+    write(backup + "/xochitl/a/0.rm", "changed")
+    write(backup + "/xochitl/c/0.rm", "new")
+    take(store, backup)
+
+    target = str(tmp_path / "restored")
+    store.restore(store.names()[-1], target, ["xochitl", "templates"])
+    write(target + "/outside.txt", "kept")
+    write(target + "/xochitl/extra.metadata", "removed")
+    assert store.restore(first, target, ["xochitl", "templates"]) == 4
+    # the files of the snapshot, with their modification times, and the
+    # files outside of the restored folders
+    restored = localListing(target)
+    assert set(restored) == {"outside.txt", "xochitl/a.metadata", "xochitl/a/0.rm", "xochitl/b.metadata",
+                             "templates/t.svg"}
+    assert restored["xochitl/a/0.rm"][1] == 1000
+    with open(target + "/xochitl/a/0.rm") as f:
+        assert f.read() == "page"
+    # the folders emptied by the restore are removed
+    assert not os.path.exists(target + "/xochitl/c")
+
+
+def test_unknown_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    with pytest.raises(ValueError):
+        store.load("missing")
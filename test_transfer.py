@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Tests of the incremental transfers (transfer.py): the files copied
+# against the manifest of the last transfer, the batches of the pipelined
+# pull and the listing of the tablet.
+#
+import os
+
+import pytest
+
+from syncstate import SyncState
+from transfer import (LocalTransport, RemarkableTransport, changedPaths, documentBatches, localListing, pull,
+                      push)
+
+
+def write(path, data, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = SyncState(str(tmp_path / "sync.db"))
+    yield state
+    state.close()
+
+
+@pytest.fixture
+def device(tmp_path):
+    device = str(tmp_path / "device")
+    write(device + "/a.metadata", "a", 1000)
+    write(device + "/a/0.rm", "page", 1000)
+    write(device + "/b.metadata", "b", 1000)
+    write(device + "/a.thumbnails/0.png", "thumbnail", 1000)
+    write(device + "/c.metadata.tmp", "interrupted", 1000)
+    return device
+
+
+def test_changed_paths():
+    remote = {"same": (1, 1000.), "rounded": (1, 1000.5), "changed": (2, 1000.), "new": (1, 1000.),
+              "missing": (1, 1000.)}
+    local = {"same": (1, 1000.), "rounded": (1, 1000.), "changed": (2, 1000.), "new": (1, 1000.)}
+    manifest = {"same": (1, 1000.), "rounded": (1, 1000.), "changed": (1, 1000.), "missing": (1, 1000.)}
+    # a file never transferred is compared with the local one
+    assert changedPaths(remote, local, manifest) == ["changed", "missing"]
+
+
+def test_pull_copies_only_the_changes(tmp_path, state, device):
+    backup = str(tmp_path / "backup")
+    transport = LocalTransport(device)
+    assert pull(transport, backup, state, "/xochitl") == ["a.metadata", "a/0.rm", "b.metadata"]
+    assert set(localListing(backup)) == {"a.metadata", "a/0.rm", "b.metadata"}
+    assert pull(transport, backup, state, "/xochitl") == []
+
+    write(device + "/a/0.rm", "changed page", 2000)
+    assert pull(transport, backup, state, "/xochitl") == ["a/0.rm"]
+    with open(backup + "/a/0.rm") as f:
+        assert f.read() == "changed page"
+    # the manifest is per root
+    assert state.manifest("/templates") == {}
+
+
+def test_push_copies_only_the_changes(tmp_path, state, device):
+    backup = str(tmp_path / "backup")
+    transport = LocalTransport(device)
+    pull(transport, backup, state, "/xochitl")
+    assert push(transport, backup, state, "/xochitl") == []
+
+    write(backup + "/a.metadata", "renamed", 3000)
+    write(backup + "/d.metadata", "new", 3000)
+    # already on the device, never transferred
+    write(backup + "/e.metadata", "e", 1000)
+    write(device + "/e.metadata", "e", 1000)
+    assert push(transport, backup, state, "/xochitl") == ["a.metadata", "d.metadata"]
+    with open(device + "/a.metadata") as f:
+        assert f.read() == "renamed"
+    assert push(transport, backup, state, "/xochitl") == []
+
+
+def test_document_batches():
+    listing = {"a.metadata": (1, 0), "a.content": (1, 0), "a.pdf": (6, 0), "a/0.rm": (2, 0),
+               "b.metadata": (1, 0), "b/0.rm": (3, 0), "c/0.rm": (20, 0)}
+    describing, batches = documentBatches(sorted(listing), listing, 10)
+    assert describing == ["a.content", "a.metadata", "b.metadata"]
+    # whole entries, a single entry larger than the batch is not split
+    assert batches == [(["a"], ["a.pdf", "a/0.rm"]), (["b"], ["b/0.rm"]), (["c"], ["c/0.rm"])]
+    describing, batches = documentBatches(sorted(listing), listing, 10, order=["c", "b"])
+    assert [UUIDs for UUIDs, paths in batches] == [["c"], ["b"], ["a"]]
+
+
+def test_tablet_listing():
+    transport = RemarkableTransport("root", "10.11.99.1", "/home/root/xochitl/")
+    commands = []
+
+    def ssh(command):
+        commands.append(command)
+        return ("/home/root/xochitl/a.metadata\t12\t1000\n"
+                "/home/root/xochitl/a/0.rm\t2048\t1001\n"
+                "/home/root/xochitl/a.thumbnails/0.png\t10\t1000\n"
+                "/home/root/xochitl/b.pdf.tmp\t10\t1000\n")
+    transport.ssh = ssh
+    assert transport.listing() == {"a.metadata": (12, 1000.), "a/0.rm": (2048, 1001.)}
+    assert "-printf" not in commands[0] and "stat -c" in commands[0]
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# Tests of the upload of the library (sync.py): the library files are
+# compared with the backup by content hash, moved or renamed files only get
+# their metadata updated. And of the upload plan (upload.py): applied in one
+# batch, an entry only shows up once all its files are written.
+#
+import os
+import json
+import shutil
+
+import pytest
+
+import sync
+import rmgen
+from profiles import Profile
+from upload import UploadPlan
+
+
+@pytest.fixture
+def library(tmp_path):
+    # two exported PDFs of the same content, Paper 0 and Paper 1
+    backup, library = str(tmp_path / "backup"), str(tmp_path / "library")
+    os.makedirs(library)
+    UUIDs = rmgen.makeTree(backup, 2, notebooks=0, strokes=5, segments=5)
+    profile = Profile("test", library, backup, sync.remarkableIP, sync.remarkableUsername)
+    sync.useProfile(profile)
+    sync.convertFiles()
+    yield library, UUIDs
+    profile.state.close()
+    sync.useProfile(None)
+
+
+def metadata(UUID):
+    with open(sync.backupDirectory(sync.remContent) + "/" + UUID + ".metadata") as f:
+        return json.load(f)
+
+
+def test_unchanged_library_plans_nothing(library):
+    assert len(sync.prepareUpload(False)) == 0
+
+
+def test_moved_file_updates_the_metadata(library):
+    library, UUIDs = library
+    os.makedirs(library + "/Moved")
+    os.rename(library + "/Paper 0.pdf", library + "/Moved/Renamed.pdf")
+    # not exported again to its old place
+    sync.convertFiles()
+    assert not os.path.exists(library + "/Paper 0.pdf")
+
+    plan = sync.prepareUpload(False)
+    # the document of the same content whose library file is still there is
+    # left alone
+    assert plan.documents == [] and [update["uuid"] for update in plan.updates] == [UUIDs[0]]
+    assert plan.updates[0]["source"] is None
+    assert metadata(UUIDs[0])["visibleName"] == "Renamed"
+    assert metadata(UUIDs[0])["parent"] == plan.folders[0]["uuid"]
+    assert metadata(UUIDs[1])["visibleName"] == "Paper 1"
+    sync.resetIndex()
+    assert len(sync.prepareUpload(False)) == 0
+
+
+def test_changed_file_is_uploaded(library):
+    library, UUIDs = library
+    with open(library + "/Paper 1.pdf", "ab") as f:
+        f.write(b"\n% edited\n")
+    plan = sync.prepareUpload(False)
+    assert [(update["uuid"], os.path.normpath(update["source"])) for update in plan.updates] \
+        == [(UUIDs[1], library + "/Paper 1.pdf")]
+    assert sync.loadState().fileHash(sync.backupDirectory(sync.remContent) + "/" + UUIDs[1] + ".pdf") \
+        == sync.loadState().fileHash(library + "/Paper 1.pdf")
+
+
+def test_copy_is_a_new_document(library):
+    library, UUIDs = library
+    shutil.copy(library + "/Paper 1.pdf", library + "/Copy.pdf")
+    plan = sync.prepareUpload(False)
+    assert plan.updates == [] and [document["metadata"]["visibleName"] for document in plan.documents] == ["Copy"]
+
+
+def test_plan_applied(tmp_path):
+    xochitl = str(tmp_path / "xochitl")
+    os.makedirs(xochitl)
+    (tmp_path / "book.pdf").write_bytes(b"%PDF")
+    plan = UploadPlan(xochitl)
+    plan.addFolder("f", {"visibleName": "Folder"}, {})
+    plan.addDocument("d", str(tmp_path / "book.pdf"), "pdf", {"visibleName": "Book", "parent": "f"},
+                     {"fileType": "pdf"})
+    plan.dump(str(tmp_path / "plan.json"))
+    with open(tmp_path / "plan.json") as f:
+        assert json.load(f) == plan.toJSON()
+    plan.apply()
+    assert sorted(os.listdir(xochitl)) == ["d", "d.cache", "d.content", "d.highlights", "d.metadata", "d.pagedata",
+                                           "d.pdf", "d.textconversion", "d.thumbnails", "f.content", "f.metadata"]
+    assert (tmp_path / "xochitl" / "d.pdf").read_bytes() == b"%PDF"
+    with open(xochitl + "/d.metadata") as f:
+        assert json.load(f) == {"visibleName": "Book", "parent": "f"}
+
+
+def test_interrupted_plan_shows_no_entry(tmp_path):
+    xochitl = str(tmp_path / "xochitl")
+    os.makedirs(xochitl)
+    (tmp_path / "xochitl" / "old.pdf").write_bytes(b"old")
+    (tmp_path / "new.pdf").write_bytes(b"new")
+    plan = UploadPlan(xochitl)
+    plan.addFolder("f", {"visibleName": "Folder"}, {})
+    plan.addUpdate("old", {"visibleName": "Old"}, str(tmp_path / "new.pdf"), "pdf")
+    plan.addDocument("d", str(tmp_path / "missing.pdf"), "pdf", {"visibleName": "Missing"}, {})
+    with pytest.raises(FileNotFoundError):
+        plan.apply()
+    # no metadata is written before all the payloads are copied, and every
+    # file is either the old or the new one, never a partial copy
+    names = os.listdir(xochitl)
+    assert not [name for name in names if name.endswith((".metadata", ".tmp"))]
+    assert (tmp_path / "xochitl" / "old.pdf").read_bytes() in (b"old", b"new")
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#
+# Incremental transfers between the reMarkable and the backup directory.
+#
+# The files of the device are listed once per transfer and compared with a
+# manifest of the size and modification time of every file as it was last
+# transferred, stored in the sync state. Only the files that changed on one
+# side are copied to the other one. The pipelined sync pulls the changed
+# files in steps: the files describing the entries first, then the payloads
+# in batches of whole entries (documentBatches), and records the manifest
+# once they are all copied (recordPull).
+#
+# A transport gives access to a directory of the device:
+#   listing()                 -> {relative path: (size, mtime)}
+#   pull(paths, directory)    copy the paths from the device to directory
+#   push(paths, directory)    copy the paths from directory to the device
+#   restart()                 reload the files on the device
+# The tablet transport raises TransferError when ssh or rclone fails.
+#
+import os
+import shutil
+import tempfile
+import subprocess
+
+# Device folders that are never transferred
+excludedSuffixes = (".thumbnails", ".cache")
+
+# Temporary files of the writes that replace files, left behind when a write
+# is interrupted
+temporarySuffix = ".tmp"
+
+# Files describing a xochitl entry, the others are its payload (pages,
+# PDF, EPUB)
+describingExtensions = (".metadata", ".content", ".pagedata")
+
+
+def excluded(path):
+    return path.split("/", 1)[0].endswith(excludedSuffixes) or path.endswith(temporarySuffix)
+
+
+def entryOf(path):
+    # UUID of the xochitl entry a path belongs to
+    return path.split("/", 1)[0].split(".", 1)[0]
+
+
+def sameFile(a, b):
+    # mtimes are compared to the second, not every transport keeps more
+    return a is not None and b is not None and a[0] == b[0] and abs(a[1] - b[1]) < 1
+
+
+def localListing(directory):
+    listing = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            relativePath = os.path.relpath(path, directory).replace(os.sep, "/")
+            if excluded(relativePath):
+                continue
+            st = os.stat(path)
+            listing[relativePath] = (st.st_size, st.st_mtime)
+    return listing
+
+
+class LocalTransport:
+    # A device mirrored in a local directory, to use the sync without a tablet
+    def __init__(self, directory):
+        self.directory = directory
+
+    def listing(self):
+        return localListing(self.directory)
+
+    def pull(self, paths, directory):
+        copyFiles(paths, self.directory, directory)
+
+    def push(self, paths, directory):
+        copyFiles(paths, directory, self.directory)
+
+    def restart(self):
+        pass
+
+
+class TransferError(Exception):
+    pass
+
+
+def run(command, **options):
+    # returns the output of command, raises TransferError when it fails
+    try:
+        return subprocess.run(command, check=True, universal_newlines=True, **options).stdout
+    except subprocess.CalledProcessError as error:
+        raise TransferError(command[0] + " exited with status " + str(error.returncode)) from None
+    except OSError as error:
+        raise TransferError("cannot run " + command[0] + ": " + str(error)) from None
+
+
+class RemarkableTransport:
+    # The tablet itself: listed with a single find over ssh, with the find
+    # and stat of busybox, copied with rclone restricted to the given files
+    def __init__(self, username, ip, directory, remote="remarkable:"):
+        self.username = username
+        self.ip = ip
+        self.directory = directory
+        self.remote = remote
+
+    def ssh(self, command):
+        return run(["ssh", self.username + "@" + self.ip, command], stdout=subprocess.PIPE)
+
+    def listing(self):
+        # busybox find has no -printf, stat prints the whole paths and the
+        # mtimes to the second
+        listing = {}
+        prefix = self.directory.rstrip("/") + "/"
+        output = self.ssh("find " + self.directory + " -type f -exec stat -c '%n\t%s\t%Y' {} +")
+        for line in output.splitlines():
+            path, size, mtime = line.rsplit("\t", 2)
+            path = path[len(prefix):] if path.startswith(prefix) else path
+            if not excluded(path):
+                listing[path] = (int(size), float(mtime))
+        return listing
+
+    def rclone(self, paths, source, destination):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as filesFrom:
+            filesFrom.write("\n".join(paths) + "\n")
+            filesFrom.flush()
+            run(["rclone", "copy", "-P", "--no-traverse", "--files-from-raw", filesFrom.name, source, destination])
+
+    def pull(self, paths, directory):
+        self.rclone(paths, self.remote + self.directory, directory)
+
+    def push(self, paths, directory):
+        self.rclone(paths, directory, self.remote + self.directory)
+
+    def restart(self):
+        self.ssh("systemctl restart xochitl")
+
+
+def copyFiles(paths, source, destination):
+    # the files are replaced, an interrupted copy leaves the old one intact
+    for path in paths:
+        target = os.path.join(destination, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(source, path), target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+
+def changedPaths(remote, local, manifest):
+    # The files of the device listing remote that changed since the last
+    # transfer, or that are missing from the local listing
+    paths = []
+    for path, signature in sorted(remote.items()):
+        known = manifest.get(path, local.get(path))
+        if not sameFile(signature, known) or path not in local:
+            paths.append(path)
+    return paths
+
+
+def recordPull(state, root, remote):
+    # record every file, also the ones that were already up to date
+    manifest = state.manifest(root)
+    state.setManifest(root, [(path, signature) for path, signature in remote.items()
+                             if not sameFile(signature, manifest.get(path))])
+    state.commit()
+
+
+def pull(transport, directory, state, root):
+    # Copies the files changed on the device since the last transfer
+    # returns the paths that were copied
+    remote = transport.listing()
+    paths = changedPaths(remote, localListing(directory), state.manifest(root))
+    if paths:
+        transport.pull(paths, directory)
+    recordPull(state, root, remote)
+    return paths
+
+
+def documentBatches(paths, listing, maxBytes, order=None):
+    # Splits the paths of a xochitl directory into the files describing the
+    # entries, and batches of the payloads of whole entries, of at most
+    # maxBytes unless a single entry is larger. The entries are batched in
+    # the order of the list of UUIDs order, by UUID when not given.
+    # returns the describing paths and a list of (UUIDs, paths)
+    describing = []
+    payloads = {}
+    for path in paths:
+        if "/" not in path and path.endswith(describingExtensions):
+            describing.append(path)
+        else:
+            payloads.setdefault(entryOf(path), []).append(path)
+    batches = []
+    UUIDs, batch, size = [], [], 0
+    rank = {UUID: n for n, UUID in enumerate(order or [])}
+    for UUID, entryPaths in sorted(payloads.items(), key=lambda item: (rank.get(item[0], len(rank)), item[0])):
+        entrySize = sum(listing[path][0] for path in entryPaths)
+        if batch and size + entrySize > maxBytes:
+            batches.append((UUIDs, batch))
+            UUIDs, batch, size = [], [], 0
+        UUIDs.append(UUID)
+        batch.extend(entryPaths)
+        size += entrySize
+    if batch:
+        batches.append((UUIDs, batch))
+    return describing, batches
+
+
+def push(transport, directory, state, root):
+    # Copies the files changed in the backup since the last transfer
+    # returns the paths that were copied
+    manifest = state.manifest(root)
+    local = localListing(directory)
+    if any(path not in manifest for path in local):
+        # files never transferred, they are only pushed if the device does
+        # not have them already
+        remote = transport.listing()
+        known = [(path, remote[path]) for path in local if path not in manifest and path in remote]
+        manifest.update(known)
+        state.setManifest(root, known)
+    paths = [path for path, signature in sorted(local.items())
+             if not sameFile(signature, manifest.get(path))]
+    if paths:
+        transport.push(paths, directory)
+        state.setManifest(root, [(path, local[path]) for path in paths])
+    state.commit()
+    return paths
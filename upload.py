@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Upload plan: the folders, documents and metadata updates to write into the
+# xochitl backup directory.
+#
+# The plan is built in memory first, so that it can be printed or dumped as
+# JSON without touching the backup. apply() then performs all the writes in
+# one batch: the file payloads are copied first (in parallel), then the
+# .content/.pagedata files and the .metadata files last, since an entry
+# only shows up once its .metadata exists. Every file is written to a
+# temporary name and renamed, an interrupted upload never leaves a
+# truncated file behind.
+#
+import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Directories created next to a new document
+documentDirectories = ("", ".thumbnails", ".textconversion", ".highlights", ".cache")
+
+
+def atomicWrite(path, data):
+    temp = path + ".tmp"
+    with open(temp, "w") as outfile:
+        outfile.write(data)
+    os.replace(temp, path)
+
+
+def atomicCopy(source, path):
+    temp = path + ".tmp"
+    shutil.copyfile(source, temp)
+    os.replace(temp, path)
+
+
+class UploadPlan:
+    def __init__(self, directory):
+        self.directory = directory
+        self.folders = []    # {"uuid", "metadata", "content"}
+        self.documents = []  # {"uuid", "source", "type", "metadata", "content"}
+        self.updates = []    # {"uuid", "metadata", "source", "type"}
+
+    def __len__(self):
+        return len(self.folders) + len(self.documents) + len(self.updates)
+
+    def addFolder(self, UUID, metadata, content):
+        self.folders.append({"uuid": UUID, "metadata": metadata, "content": content})
+
+    def addDocument(self, UUID, source, fType, metadata, content):
+        self.documents.append({"uuid": UUID, "source": source, "type": fType,
+                               "metadata": metadata, "content": content})
+
+    def addUpdate(self, UUID, metadata, source=None, fType=None):
+        # new metadata, and new content when source is given
+        self.updates.append({"uuid": UUID, "metadata": metadata, "source": source, "type": fType})
+
+    def toJSON(self):
+        return {"folders": self.folders, "documents": self.documents, "updates": self.updates}
+
+    def dump(self, path):
+        with open(path, "w") as outfile:
+            json.dump(self.toJSON(), outfile, indent=1)
+
+    def apply(self, jobs=4):
+        basePath = self.directory + "/"
+        for document in self.documents:
+            for directory in documentDirectories:
+                os.makedirs(basePath + document["uuid"] + directory, exist_ok=True)
+
+        # the payloads first, large files are copied in parallel
+        copies = [(entry["source"], basePath + entry["uuid"] + "." + entry["type"])
+                  for entry in self.documents + self.updates if entry["source"]]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(atomicCopy, *copy) for copy in copies]:
+                future.result()
+
+        for document in self.documents:
+            atomicWrite(basePath + document["uuid"] + ".content", json.dumps(document["content"]))
+            atomicWrite(basePath + document["uuid"] + ".pagedata", "")
+        for folder in self.folders:
+            atomicWrite(basePath + folder["uuid"] + ".content", json.dumps(folder["content"]))
+
+        # the metadata last, it makes the entries visible
+        for entry in self.folders + self.documents + self.updates:
+            atomicWrite(basePath + entry["uuid"] + ".metadata", json.dumps(entry["metadata"]))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Filesystem watchers for the watch mode of the sync.
+#
+# InotifyWatcher uses the Linux inotify API through ctypes, PollingWatcher
+# compares snapshots of the directory trees and is used where inotify is not
+# available. Both watch whole directory trees and report the paths that
+# changed:
+#   wait(timeout) -> set of changed paths, empty when nothing happened
+# The set holds overflowed when events were lost, anything may have changed.
+#
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+watchMask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+             IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+eventHeader = struct.Struct("iIII")
+
+# Reported instead of the paths when the events overflowed the queue
+overflowed = object()
+
+
+class InotifyWatcher:
+    def __init__(self, roots):
+        self.roots = roots
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.addWatch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}  # watch descriptor -> directory
+        for root in roots:
+            self.watchTree(root)
+
+    def watchTree(self, root):
+        for directory, dirs, files in os.walk(root):
+            wd = self.addWatch(self.fd, os.fsencode(directory), watchMask)
+            if wd < 0:
+                if ctypes.get_errno() == errno.ENOSPC:
+                    raise OSError(errno.ENOSPC, "inotify watch limit reached")
+                continue
+            self.directories[wd] = directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = eventHeader.unpack_from(data, offset)
+            offset += eventHeader.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, everything may have changed, and the
+                # folders created meanwhile are not watched yet
+                changed.add(overflowed)
+                for root in self.roots:
+                    self.watchTree(root)
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # watch new folders, and report what they already contain
+                self.watchTree(path)
+                for subdirectory, dirs, files in os.walk(path):
+                    changed.update(os.path.join(subdirectory, f) for f in files)
+        return changed
+
+
+class PollingWatcher:
+    def __init__(self, roots, interval=2.0):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for root in self.roots:
+            for directory, dirs, files in os.walk(root):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def close(self):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        changed = {path for path in snapshot.keys() | self.snapshot.keys()
+                   if snapshot.get(path) != self.snapshot.get(path)}
+        self.snapshot = snapshot
+        return changed
+
+
+def makeWatcher(roots):
+    try:
+        return InotifyWatcher(roots)
+    except (OSError, AttributeError):
+        # not on Linux, or out of inotify watches
+        return PollingWatcher(roots)
+
+
+def waitForChanges(watcher, quiet=2.0):
+    # Blocks until something changed, then collects events until nothing
+    # happened for quiet seconds
+    changed = set()
+    while not changed:
+        changed = watcher.wait(60)
+    while True:
+        more = watcher.wait(quiet)
+        if not more:
+            return changed
+        changed |= more